@@ -5,21 +5,105 @@ except ImportError:
 
 from django.core.exceptions import FieldError
 from django.db import models as django_models
+from django.db.models.options import normalize_together
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from nested_intervals.cache import invalidate_instance
+
+from nested_intervals.capacity import DEFAULT_MAX_DIGITS
+from nested_intervals.capacity import get_safe_max_value
+from nested_intervals.capacity import get_storage_max_value
 
 def get_model_field_names(model_class):
     return tuple(field.name for field in model_class._meta.fields)
 
+def build_nested_intervals_field(storage, max_digits=DEFAULT_MAX_DIGITS):
+    if storage == 'integer':
+        return django_models.PositiveIntegerField()
+    if storage == 'bigint':
+        # PositiveBigIntegerField only exists from Django 3.1
+        return getattr(django_models, 'PositiveBigIntegerField', django_models.BigIntegerField)()
+    if storage == 'decimal':
+        return django_models.DecimalField(max_digits=max_digits, decimal_places=0)
+    raise ValueError("Unknown storage '{}', expected 'integer', 'bigint' or 'decimal'.".format(storage))
+
+def add_together(model_class, option, field_names):
+    # Migrations read the options from original_attrs
+    together = tuple(normalize_together(getattr(model_class._meta, option))) + (tuple(field_names),)
+    setattr(model_class._meta, option, together)
+    model_class._meta.original_attrs[option] = together
+
 def register_fields(model_class, *field_names, **kwargs):
+    """
+    The 'storage' keyword argument picks the column type of the 4 nested
+    intervals fields, which bounds how deep and wide the tree can grow:
+    'integer' (default), 'bigint' or 'decimal' with 'max_digits' digits.
+
+    With 'indexes=True', (a11, a21) is made unique, which identifies a
+    node and its parent, (a12, a22, a11) is indexed to find children and
+    the last child, and (a21, a11) is indexed to bound descendants lookups.
+
+    'interval_fields' names 2 extra float fields that store the bounds of
+    each node's interval, (a11 - a12) / (a21 - a22) and a11 / a21, so that
+    descendants can be found with an indexed range scan.
+
+    'depth_field' names an extra integer field that stores the number of
+    ancestors of each node, so that levels can be filtered with an index.
+
+    'cache' takes a cache from nested_intervals.cache, to resolve parents,
+    roots and ancestors without queries.
+    """
     assert len(field_names) == 5, 'First 4 names are for nested intervals integer fields. The 5th name is a parent field.'
     model_class._nested_intervals_field_names = field_names
 
+    storage = kwargs.get('storage', 'integer')
+    max_digits = kwargs.get('max_digits', DEFAULT_MAX_DIGITS)
+    model_class._nested_intervals_storage_max_value = get_storage_max_value(storage, max_digits)
+    model_class._nested_intervals_max_value = get_safe_max_value(storage, max_digits)
+
     # Register nested interval fields
 
     for field_name in field_names[0:-1]:
         if field_name in get_model_field_names(model_class):
             raise FieldError("'{}' is already an existing model field.".format(field_name))
 
-        django_models.PositiveIntegerField().contribute_to_class(model_class, field_name)
+        build_nested_intervals_field(storage, max_digits).contribute_to_class(model_class, field_name)
+
+    interval_field_names = kwargs.get('interval_fields', None)
+    model_class._nested_intervals_interval_field_names = interval_field_names
+
+    if interval_field_names:
+        assert len(interval_field_names) == 2, 'Interval fields need a name for the left and the right bound.'
+        for field_name in interval_field_names:
+            if field_name in get_model_field_names(model_class):
+                raise FieldError("'{}' is already an existing model field.".format(field_name))
+
+            # Nullable so the fields can be added to an existing table,
+            # then filled with queryset.update_intervals.
+            django_models.FloatField(null=True, db_index=True).contribute_to_class(model_class, field_name)
+
+    depth_field_name = kwargs.get('depth_field', None)
+    model_class._nested_intervals_depth_field_name = depth_field_name
+
+    if depth_field_name:
+        if depth_field_name in get_model_field_names(model_class):
+            raise FieldError("'{}' is already an existing model field.".format(depth_field_name))
+
+        # Nullable so the field can be added to an existing table,
+        # then filled with rebuild_nested_intervals.
+        django_models.PositiveIntegerField(null=True, db_index=True).contribute_to_class(model_class, depth_field_name)
+
+    model_class._nested_intervals_cache = kwargs.get('cache', None)
+    if model_class._nested_intervals_cache is not None:
+        post_save.connect(invalidate_instance, sender=model_class, weak=False)
+        post_delete.connect(invalidate_instance, sender=model_class, weak=False)
+
+    if kwargs.get('indexes', False):
+        name11, name12, name21, name22 = field_names[0:-1]
+        add_together(model_class, 'unique_together', (name11, name21))
+        add_together(model_class, 'index_together', (name12, name22, name11))
+        add_together(model_class, 'index_together', (name21, name11))
 
     # Register parent field
 
@@ -0,0 +1,105 @@
+"""
+Matrix operations over many nodes at once. Every function takes the abs
+values of the nodes as stored in the four registered fields, as one column
+per field, and returns columns.
+
+With NumPy installed the columns are int64 arrays whenever the largest
+intermediate result is known to fit in int64, and object arrays of Python
+ints otherwise, so the results never overflow. Without NumPy plain lists
+are used.
+"""
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INT64_MAX = 2 ** 63 - 1
+
+def largest(*columns):
+    return max(int(max(column)) if len(column) else 0 for column in columns)
+
+def as_arrays(bound, *columns):
+    """
+    bound is the largest intermediate result the caller computes from
+    the columns.
+    """
+    if bound <= INT64_MAX:
+        return tuple(numpy.asarray(column, dtype=numpy.int64) for column in columns)
+    return tuple(numpy.array([int(num) for num in column], dtype=object) for column in columns)
+
+def matrix_columns(queryset):
+    """
+    Returns (pks, a11, a12, a21, a22) of every row in queryset.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    rows = tuple(queryset.values_list('pk', name11, name12, name21, name22))
+    if not rows:
+        return ((),) * 5
+    return tuple(izip(*rows))
+
+def nths(a11, a12):
+    if numpy is None:
+        return [v11 // v12 for v11, v12 in izip(a11, a12)]
+    a11, a12 = as_arrays(largest(a11), a11, a12)
+    return a11 // a12
+
+def parent_matrices(a11, a12, a21, a22):
+    if numpy is None:
+        columns = ([], [], [], [])
+        for v11, v12, v21, v22 in izip(a11, a12, a21, a22):
+            nth_child = v11 // v12
+            for column, num in izip(columns, (
+                    v12,
+                    v12 * (nth_child + 1) - v11,
+                    v22,
+                    v22 * (nth_child + 1) - v21)):
+                column.append(num)
+        return columns
+
+    # v12 * (nth + 1) is at most v11 + v12
+    a11, a12, a21, a22 = as_arrays(2 * largest(a11, a12, a21, a22), a11, a12, a21, a22)
+    nth_child = a11 // a12
+    return (
+        a12,
+        a12 * (nth_child + 1) - a11,
+        a22,
+        a22 * (nth_child + 1) - a21)
+
+def child_matrices(a11, a12, a21, a22, nths):
+    if numpy is None:
+        columns = ([], [], [], [])
+        for v11, v12, v21, v22, nth_child in izip(a11, a12, a21, a22, nths):
+            assert nth_child >= 1
+            for column, num in izip(columns, (
+                    v11 * (nth_child + 1) - v12,
+                    v11,
+                    v21 * (nth_child + 1) - v22,
+                    v21)):
+                column.append(num)
+        return columns
+
+    a11, a12, a21, a22, nths = as_arrays(
+        largest(a11, a12, a21, a22) * (largest(nths) + 1),
+        a11, a12, a21, a22, nths)
+    assert (nths >= 1).all()
+    return (
+        a11 * (nths + 1) - a12,
+        a11,
+        a21 * (nths + 1) - a22,
+        a21)
+
+def descendant_mask(a11, a12, a21, a22, matrix):
+    """
+    True for every node that is a strict descendant of matrix.
+    """
+    p11, p12, p21, p22 = (abs(num) for num in matrix)
+    if numpy is None:
+        return [
+            v11 * p21 < v21 * p11 and v11 * (p21 - p22) > v21 * (p11 - p12)
+            for v11, v21 in izip(a11, a21)
+        ]
+
+    a11, a21 = as_arrays(largest(a11, a21) * max(p11, p21), a11, a21)
+    return (a11 * p21 < a21 * p11) & (a11 * (p21 - p22) > a21 * (p11 - p12))
@@ -0,0 +1,221 @@
+"""
+Caches of model instances keyed by their (a11, a21) pair, so that parents,
+roots and ancestors, whose matrices are computed from a node's matrix,
+can be resolved without a query.
+
+Pass a cache to register_fields with the 'cache' keyword argument. Any
+object with get, set, delete and clear methods works, and get_many and
+set_many are used for batches where the cache has them.
+
+LRUCache lives in the memory of one process, and is only invalidated by
+changes made in that process. With more than one worker process, either
+add LRUCacheMiddleware, which clears every LRUCache at the start and end
+of each request, or use DjangoCache with a cache shared by the workers.
+"""
+from collections import OrderedDict
+import copy
+import threading
+import weakref
+
+from django.core.cache import caches
+
+
+class LRUCache(object):
+    """
+    A process local cache that evicts the least recently used instance.
+    It goes stale when other processes change the tree, see above.
+    """
+    instances = weakref.WeakSet()
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        LRUCache.instances.add(self)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return None
+            self.items[key] = value
+            return value
+
+    def get_many(self, keys):
+        return dict(
+            (key, value) for key, value in ((key, self.get(key)) for key in keys)
+            if value is not None)
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def set_many(self, data):
+        for key, value in data.iteritems():
+            self.set(key, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class DjangoCache(object):
+    """
+    Stores instances in one of Django's caches. clear() only forgets the
+    keys of this cache, by moving on to a new generation of keys.
+    """
+    def __init__(self, alias='default', prefix='nested_intervals', timeout=None):
+        self.alias = alias
+        self.prefix = prefix
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def generation_key(self):
+        return '{}:generation'.format(self.prefix)
+
+    def generation(self):
+        generation = self.cache.get(self.generation_key())
+        if generation is None:
+            self.cache.add(self.generation_key(), 1, None)
+            generation = self.cache.get(self.generation_key(), 1)
+        return generation
+
+    def make_key(self, key, generation=None):
+        if generation is None:
+            generation = self.generation()
+        return '{}:{}:{}'.format(self.prefix, generation, ':'.join(str(part) for part in key))
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def get_many(self, keys):
+        """
+        One round trip for the generation and one for all of keys.
+        """
+        generation = self.generation()
+        cache_keys = dict((self.make_key(key, generation), key) for key in keys)
+        return dict(
+            (cache_keys[cache_key], value)
+            for cache_key, value in self.cache.get_many(cache_keys.keys()).iteritems())
+
+    def set(self, key, value):
+        self.cache.set(self.make_key(key), value, self.timeout)
+
+    def set_many(self, data):
+        generation = self.generation()
+        self.cache.set_many(dict(
+            (self.make_key(key, generation), value)
+            for key, value in data.iteritems()), self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+    def clear(self):
+        try:
+            self.cache.incr(self.generation_key())
+        except ValueError:
+            # The generation was evicted, which forgets every key too
+            pass
+
+def clear_lru_caches():
+    for cache in list(LRUCache.instances):
+        cache.clear()
+
+
+class LRUCacheMiddleware(object):
+    """
+    Scopes every LRUCache to a request, so that a worker never serves
+    instances another worker has changed since an earlier request.
+    """
+    def process_request(self, request):
+        clear_lru_caches()
+
+    def process_response(self, request, response):
+        clear_lru_caches()
+        return response
+
+def get_cache(Model):
+    return getattr(Model, '_nested_intervals_cache', None)
+
+def get_cache_key(Model, a11, a21):
+    return (Model._meta.app_label, Model._meta.model_name, abs(a11), abs(a21))
+
+def get_cached(Model, a11, a21):
+    cache = get_cache(Model)
+    if cache is None:
+        return None
+    node = cache.get(get_cache_key(Model, a11, a21))
+    # A copy, so changes to the returned instance never reach the cache
+    return copy.copy(node)
+
+def get_cached_many(Model, pairs):
+    """
+    Same as get_cached for every (a11, a21) pair, in one batch where the
+    cache supports it.
+    """
+    cache = get_cache(Model)
+    keys = [get_cache_key(Model, a11, a21) for a11, a21 in pairs]
+    if cache is None:
+        return [None] * len(keys)
+    if hasattr(cache, 'get_many'):
+        nodes = cache.get_many(keys)
+    else:
+        nodes = dict((key, cache.get(key)) for key in keys)
+    return [copy.copy(nodes.get(key)) for key in keys]
+
+def set_cached(node):
+    cache = get_cache(type(node))
+    if cache is not None:
+        a11, a12, a21, a22 = (
+            getattr(node, field_name)
+            for field_name in node._nested_intervals_field_names[0:-1])
+        cache.set(get_cache_key(type(node), a11, a21), copy.copy(node))
+
+def set_cached_many(nodes):
+    """
+    Same as set_cached for every node of nodes, which are of one model.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return
+    Model = type(nodes[0])
+    cache = get_cache(Model)
+    if cache is None:
+        return
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    data = dict(
+        (get_cache_key(Model, getattr(node, name11), getattr(node, name21)), copy.copy(node))
+        for node in nodes)
+    if hasattr(cache, 'set_many'):
+        cache.set_many(data)
+    else:
+        for key, node in data.iteritems():
+            cache.set(key, node)
+
+def invalidate_cached(Model, a11, a21):
+    cache = get_cache(Model)
+    if cache is not None and a11 is not None and a21 is not None:
+        cache.delete(get_cache_key(Model, a11, a21))
+
+def invalidate_cache(Model):
+    """
+    Forget every cached node of Model, after matrices of many nodes changed.
+    """
+    cache = get_cache(Model)
+    if cache is not None:
+        cache.clear()
+
+def invalidate_instance(sender, instance, **kwargs):
+    name11, name12, name21, name22, parent_name = sender._nested_intervals_field_names
+    invalidate_cached(sender, getattr(instance, name11), getattr(instance, name21))
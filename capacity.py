@@ -0,0 +1,145 @@
+"""
+Matrix entries grow like continued fraction convergents, which is linear
+in depth for a chain of first children, but exponential in depth as soon
+as nodes have more than one child. These helpers find the limits of the
+column type the nested intervals fields are stored in.
+
+The containment predicates multiply two stored entries. The products
+are computed in 64 bits: natively on SQLite and MySQL, and on PostgreSQL
+by casting integer columns to bigint. So integer storage can use its
+whole range, while bigint storage is limited to the square root of the
+64 bit range. Decimal storage relies on exact numeric products, as on
+PostgreSQL.
+"""
+from collections import namedtuple
+
+from django.db.models import F
+from django.db.models import Max
+
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import compose_path
+
+STORAGE_MAX_VALUES = {
+    # PositiveIntegerField is a 32 bit signed integer on PostgreSQL
+    'integer': 2 ** 31 - 1,
+    'bigint': 2 ** 63 - 1,
+}
+
+# The SQL products of two entries are 64 bit integers
+PRODUCT_MAX_VALUE = 2 ** 63 - 1
+
+DEFAULT_MAX_DIGITS = 38
+
+CapacityReport = namedtuple('CapacityReport', (
+    'max_value',
+    'safe_max_value',
+    'largest_value',
+    'usage',
+    'largest_nth',
+    'max_safe_depth',
+))
+
+def get_storage_max_value(storage, max_digits=DEFAULT_MAX_DIGITS):
+    if storage == 'decimal':
+        return 10 ** max_digits - 1
+    return STORAGE_MAX_VALUES[storage]
+
+def isqrt(num):
+    root = num
+    while root * root > num:
+        root = (root + num // root) // 2
+    return root
+
+def get_safe_max_value(storage, max_digits=DEFAULT_MAX_DIGITS):
+    """
+    The largest entry that fits in storage and whose product with any
+    other entry still fits in the SQL products.
+    """
+    max_value = get_storage_max_value(storage, max_digits)
+    if storage == 'decimal':
+        return max_value
+    return min(max_value, isqrt(PRODUCT_MAX_VALUE))
+
+def get_max_value(Model):
+    """
+    The largest entry new matrices of Model may have, see get_safe_max_value.
+    """
+    return getattr(Model, '_nested_intervals_max_value', None)
+
+def widest_matrix(depth, fanout):
+    """
+    The matrix with the largest entries among all nodes at depth with at
+    most fanout siblings, which is the one that is always the last child.
+    """
+    return compose_path((fanout,) * depth)
+
+def max_safe_depth(max_value, fanout=1):
+    """
+    The deepest level that can be stored and queried when every node has
+    at most fanout children, where max_value is the largest entry allowed,
+    e.g. get_max_value(Model).
+    """
+    assert fanout >= 1
+    if fanout == 1:
+        # A chain of first children is 1 1 depth+1 depth
+        return max_value - 1
+
+    depth = 0
+    a11, a12, a21, a22 = INVISIBLE_ROOT_MATRIX
+    while True:
+        a11, a12, a21, a22 = (
+            a11 * (fanout+1) + a12,
+            -a11,
+            a21 * (fanout+1) + a22,
+            -a21)
+        if max(abs(a11), abs(a12), abs(a21), abs(a22)) > max_value:
+            return depth
+        depth += 1
+
+def max_safe_fanout(max_value, depth):
+    """
+    The largest number of children every node can have, for a tree that
+    is depth levels deep and can be queried, where max_value is the
+    largest entry allowed. 0 if depth cannot be stored at all.
+    """
+    def fits(fanout):
+        return max(abs(num) for num in widest_matrix(depth, fanout)) <= max_value
+
+    low, high = 0, max_value
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def largest_value(queryset):
+    """
+    The largest value stored in any of the four fields, 0 for no rows.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    largest = queryset.aggregate(*(Max(name) for name in (name11, name12, name21, name22)))
+    return max(value or 0 for value in largest.values())
+
+def capacity_report(queryset):
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    max_value = queryset.model._nested_intervals_storage_max_value
+    safe_max_value = get_max_value(queryset.model)
+
+    largest = queryset.aggregate(
+        largest11=Max(name11),
+        largest12=Max(name12),
+        largest21=Max(name21),
+        largest22=Max(name22),
+        largest_nth=Max(F(name11) / F(name12)))
+    largest_nth = largest.pop('largest_nth') or 0
+    largest_value = max(value or 0 for value in largest.values())
+
+    return CapacityReport(
+        max_value=max_value,
+        safe_max_value=safe_max_value,
+        largest_value=largest_value,
+        usage=float(largest_value) / safe_max_value,
+        largest_nth=largest_nth,
+        max_safe_depth=max_safe_depth(safe_max_value, max(largest_nth, 1)))
@@ -0,0 +1,120 @@
+"""
+Children are always appended after the last child, so the nths of deleted
+or moved away children are never used again. Renumbering the remaining
+children to contiguous nths gives them, and all of their descendants, the
+smallest matrices possible, which leaves room for deeper and wider trees.
+"""
+from collections import namedtuple
+
+from django.db import transaction
+
+from nested_intervals.cache import invalidate_cache
+from nested_intervals.capacity import largest_value
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.queryset import descendants_of_matrix
+from nested_intervals.queryset import get_matrix_field_values
+from nested_intervals.queryset import get_signed_matrix
+from nested_intervals.queryset import matrix_keys_filter
+from nested_intervals.queryset import move_descendants_of_matrix
+from nested_intervals.utils import chunked
+
+DEFAULT_BATCH_SIZE = 100
+
+CompactionReport = namedtuple('CompactionReport', (
+    'moved',
+    'largest_value_before',
+    'largest_value_after',
+))
+
+def get_key(matrix):
+    return (abs(matrix.a11), abs(matrix.a21))
+
+def children_by_parent(queryset, parent_matrices):
+    """
+    The (pk, abs values) of the children of every matrix in
+    parent_matrices, sorted by nth and keyed by the abs (a11, a21)
+    of their parent.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    children = dict((get_key(matrix), []) for matrix in parent_matrices)
+
+    for chunk in chunked(children):
+        rows = matrix_keys_filter(queryset, name12, name22, chunk).order_by(name11).values_list(
+            'pk', name11, name12, name21, name22)
+        for pk, v11, v12, v21, v22 in rows:
+            children[(v12, v22)].append((pk, (v11, v12, v21, v22)))
+    return children
+
+def get_moves(parent_matrix, children):
+    """
+    Yields (pk, old matrix, new matrix) of every child that is not the
+    nth child of parent_matrix, where children are sorted by nth and n is
+    the position of the child.
+    """
+    for nth, (pk, values) in enumerate(children, 1):
+        old_matrix = get_signed_matrix(values)
+        new_matrix = get_child_matrix(parent_matrix, nth)
+        if old_matrix != new_matrix:
+            yield pk, old_matrix, new_matrix
+
+def move_nodes(queryset, moves, batch_size):
+    """
+    Move every node with its descendants, batch_size nodes per transaction.
+
+    Moves must be in ascending nth order for each parent. A child only
+    moves down to a smaller nth, whose slot was freed by the children
+    before it, so no two nodes ever share a matrix and the table stays
+    valid between batches.
+    """
+    moved = 0
+    for batch in chunked(moves, batch_size):
+        with transaction.atomic(using=queryset.db):
+            for pk, old_matrix, new_matrix in batch:
+                move_descendants_of_matrix(queryset, old_matrix, new_matrix)
+                queryset.filter(pk=pk).update(**get_matrix_field_values(queryset.model, new_matrix))
+        invalidate_cache(queryset.model)
+        moved += len(batch)
+    return moved
+
+def compact(queryset, matrix, batch_size, max_depth):
+    scope = descendants_of_matrix(queryset, matrix)
+    largest_value_before = largest_value(scope)
+
+    moved = 0
+    depth = 0
+    parent_matrices = (matrix,)
+    while parent_matrices and (max_depth is None or depth < max_depth):
+        children = children_by_parent(queryset, parent_matrices)
+        moves = []
+        next_parent_matrices = []
+        for parent_matrix in parent_matrices:
+            parent_children = children[get_key(parent_matrix)]
+            moves.extend(get_moves(parent_matrix, parent_children))
+            next_parent_matrices.extend(
+                get_child_matrix(parent_matrix, nth)
+                for nth in xrange(1, len(parent_children) + 1))
+
+        moved += move_nodes(queryset, moves, batch_size)
+        parent_matrices = next_parent_matrices
+        depth += 1
+
+    return CompactionReport(
+        moved=moved,
+        largest_value_before=largest_value_before,
+        largest_value_after=largest_value(scope.all()))
+
+def compact_children(queryset, parent_matrix=INVISIBLE_ROOT_MATRIX, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Renumber the children of parent_matrix to nths 1 to n, keeping their
+    order, and move their descendants along. The report covers every
+    descendant of parent_matrix.
+    """
+    return compact(queryset, parent_matrix, batch_size, 1)
+
+def compact_subtree(queryset, matrix=INVISIBLE_ROOT_MATRIX, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    compact_children for matrix and every one of its descendants, one
+    level at a time. The default compacts the whole table.
+    """
+    return compact(queryset, matrix, batch_size, None)
@@ -3,3 +3,6 @@ class NoChildrenError(Exception):
 
 class InvalidNodeError(Exception):
     pass
+
+class MatrixOverflowError(Exception):
+    pass
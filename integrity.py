@@ -0,0 +1,171 @@
+"""
+Check a whole table of nodes in streaming passes, reading the rows in
+keyset paginated chunks of values, so memory holds one chunk of rows plus
+one packed (a11, a21) key per node.
+"""
+from collections import namedtuple
+
+from nested_intervals import batch
+from nested_intervals.capacity import get_max_value
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+
+DEFAULT_CHUNK_SIZE = 10000
+
+ROOT_PARENT_KEY = (abs(INVISIBLE_ROOT_MATRIX.a11), abs(INVISIBLE_ROOT_MATRIX.a21))
+
+
+class IntegrityReport(namedtuple('IntegrityReport', (
+        'checked',
+        'null_values',
+        'bad_determinants',
+        'duplicate_keys',
+        'missing_parents',
+        'root_mismatches',
+        'out_of_range'))):
+    """
+    checked is the number of rows. duplicate_keys are the (a11, a21) pairs
+    of more than one row, every other field lists the pks of rows with:
+
+    null_values: a null nested intervals field
+    bad_determinants: a12 * a21 - a11 * a22 other than 1
+    missing_parents: no row with the (a11, a21) of their (a12, a22)
+    root_mismatches: a null parent foreign key but a parent matrix, or
+                     the other way around
+    out_of_range: a value below 0 or above the max value of the fields,
+                  these rows are left out of the other checks
+    """
+    __slots__ = ()
+
+    @property
+    def is_valid(self):
+        return not any(self[1:])
+
+def iter_chunks(queryset, field_names, chunk_size):
+    """
+    Yields lists of values_list rows of pk and field_names in pk order,
+    where every chunk is one query that seeks past the last pk.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk_queryset.values_list('pk', *field_names)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
+
+
+class KeyIndex(object):
+    """
+    A set of (a11, a21) pairs packed into single ints. With NumPy and
+    values small enough to pack into int64, the keys are kept in a sorted
+    int64 array, otherwise in a set of Python ints. Only pairs of values
+    from 0 to max_value can be added, other pairs are never found.
+    """
+    def __init__(self, max_value):
+        self.base = max_value + 1
+        self.use_numpy = batch.numpy is not None and self.base ** 2 <= batch.INT64_MAX
+        self.chunks = []
+        self.keys = None
+
+    def fits(self, *values):
+        return all(0 <= value < self.base for value in values)
+
+    def pack(self, v11, v21):
+        return int(v11) * self.base + int(v21)
+
+    def add(self, pairs):
+        chunk = []
+        for v11, v21 in pairs:
+            assert self.fits(v11, v21), 'Pair ({}, {}) is out of range'.format(v11, v21)
+            chunk.append(self.pack(v11, v21))
+        if self.use_numpy:
+            chunk = batch.numpy.asarray(chunk, dtype=batch.numpy.int64)
+        self.chunks.append(chunk)
+
+    def duplicates(self):
+        """
+        Seal the index and return the pairs that were added more than once.
+        """
+        if self.use_numpy:
+            numpy = batch.numpy
+            keys = numpy.sort(numpy.concatenate(
+                self.chunks or [numpy.zeros(0, dtype=numpy.int64)]))
+            duplicates = numpy.unique(keys[1:][keys[1:] == keys[:-1]])
+            self.keys = numpy.unique(keys)
+        else:
+            self.keys = set()
+            duplicates = set()
+            for chunk in self.chunks:
+                for key in chunk:
+                    if key in self.keys:
+                        duplicates.add(key)
+                    self.keys.add(key)
+        self.chunks = None
+        return sorted(divmod(int(key), self.base) for key in duplicates)
+
+    def missing(self, pairs):
+        """
+        For every pair, whether it was not added.
+        """
+        # -1 is never added
+        packed = [self.pack(v11, v21) if self.fits(v11, v21) else -1 for v11, v21 in pairs]
+        if self.use_numpy:
+            numpy = batch.numpy
+            return [not found for found in numpy.in1d(
+                numpy.asarray(packed, dtype=numpy.int64), self.keys)]
+        return [key not in self.keys for key in packed]
+
+
+def check_integrity(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns an IntegrityReport of every row in queryset, read in two
+    passes: the first checks every row on its own and indexes the
+    (a11, a21) pairs, the second looks up the parent of every row.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    index = KeyIndex(get_max_value(queryset.model))
+
+    checked = 0
+    out_of_range = []
+    null_values = []
+    bad_determinants = []
+    root_mismatches = []
+    for rows in iter_chunks(queryset, (name11, name12, name21, name22, parent_name+'_id'), chunk_size):
+        pairs = []
+        for pk, v11, v12, v21, v22, parent_id in rows:
+            checked += 1
+            if None in (v11, v12, v21, v22):
+                null_values.append(pk)
+                continue
+            if not index.fits(v11, v12, v21, v22):
+                out_of_range.append(pk)
+                continue
+            pairs.append((v11, v21))
+            if v12 * v21 - v11 * v22 != 1:
+                bad_determinants.append(pk)
+            if (parent_id is None) != ((v12, v22) == ROOT_PARENT_KEY):
+                root_mismatches.append(pk)
+        index.add(pairs)
+
+    duplicate_keys = index.duplicates()
+
+    missing_parents = []
+    skipped = set(out_of_range)
+    for rows in iter_chunks(queryset, (name12, name22), chunk_size):
+        rows = [
+            (pk, v12, v22) for pk, v12, v22 in rows
+            if None not in (v12, v22) and (v12, v22) != ROOT_PARENT_KEY and pk not in skipped]
+        for (pk, v12, v22), missing in zip(rows, index.missing((v12, v22) for pk, v12, v22 in rows)):
+            if missing:
+                missing_parents.append(pk)
+
+    return IntegrityReport(
+        checked=checked,
+        null_values=null_values,
+        bad_determinants=bad_determinants,
+        duplicate_keys=duplicate_keys,
+        missing_parents=missing_parents,
+        root_mismatches=root_mismatches,
+        out_of_range=out_of_range)
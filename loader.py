@@ -0,0 +1,118 @@
+"""
+Load a whole forest given as (id, parent_id) pairs, e.g. an existing
+adjacency list table, into the nested intervals fields of its rows.
+
+Every matrix is computed in memory from its parent's matrix, in a single
+pass from the roots down, and written with chunked bulk updates. Memory
+holds the ids of all pairs, but never the model instances.
+"""
+from collections import defaultdict
+import csv
+
+from django.db import transaction
+
+from nested_intervals.cache import invalidate_cache
+from nested_intervals.capacity import get_max_value
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.queryset import bulk_update_values
+from nested_intervals.queryset import get_matrix_field_names
+from nested_intervals.queryset import get_matrix_field_values
+from nested_intervals.utils import chunked
+
+DEFAULT_CHUNK_SIZE = 1000
+
+def pairs_from_queryset(queryset):
+    parent_name = queryset.model._nested_intervals_field_names[-1]
+    return queryset.order_by('pk').values_list('pk', parent_name+'_id').iterator()
+
+def pairs_from_csv(csv_file, id_column='id', parent_column='parent_id', convert=int):
+    """
+    An empty parent column is a root.
+    """
+    for row in csv.DictReader(csv_file):
+        parent_id = row[parent_column]
+        yield convert(row[id_column]), (convert(parent_id) if parent_id else None)
+
+def children_by_parent_id(pairs):
+    """
+    Returns the ids of the children of every parent id in input order,
+    with the roots under None, and the number of pairs.
+    """
+    children = defaultdict(list)
+    count = 0
+    for pk, parent_id in pairs:
+        children[parent_id].append(pk)
+        count += 1
+    return children, count
+
+def count_reachable(children):
+    count = 0
+    stack = [None]
+    while stack:
+        child_ids = children.get(stack.pop(), ())
+        count += len(child_ids)
+        stack.extend(child_ids)
+    return count
+
+def iter_matrices(children, max_value=None):
+    """
+    Yields (id, parent_id, matrix) with every parent before its children,
+    where siblings are numbered in input order. Consumes children.
+    """
+    stack = [(None, INVISIBLE_ROOT_MATRIX)]
+    while stack:
+        parent_id, parent_matrix = stack.pop()
+        for nth, pk in enumerate(children.pop(parent_id, ()), 1):
+            matrix = get_child_matrix(parent_matrix, nth, max_value)
+            yield pk, parent_id, matrix
+            stack.append((pk, matrix))
+
+def load_tree(queryset, pairs, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Set the matrix and parent of every row in pairs. Ids that are not
+    rows of queryset are skipped. The whole load is one transaction,
+    written in chunks, after each of which progress, if given, is called
+    with the number of pairs written so far and the total.
+
+    Raises ValueError, before anything is written, when some pairs cannot
+    be reached from a root, because of a cycle or a missing parent.
+
+    The rows are first moved to (a11, a21) pairs with a11 = 0, which no
+    matrix has, so that a row that is not yet written never holds the
+    matrix the unique (a11, a21) index expects for another row.
+
+    Returns the number of updated rows.
+    """
+    Model = queryset.model
+    parent_name = Model._nested_intervals_field_names[-1]
+    matrix_field_names = get_matrix_field_names(Model)
+
+    children, count = children_by_parent_id(pairs)
+    reachable = count_reachable(children)
+    if reachable != count:
+        raise ValueError('{} of {} ids cannot be reached from a root.'.format(
+            count - reachable, count))
+
+    def iter_rows():
+        for pk, parent_id, matrix in iter_matrices(children, get_max_value(Model)):
+            values = get_matrix_field_values(Model, matrix)
+            yield pk, tuple(values[name] for name in matrix_field_names) + (parent_id,)
+
+    name11, name12, name21, name22 = matrix_field_names[0:4]
+    placeholders = (
+        (pk, (0, i))
+        for i, pk in enumerate((pk for child_ids in children.itervalues() for pk in child_ids), 1))
+
+    invalidate_cache(Model)
+    written = 0
+    updated = 0
+    with transaction.atomic(using=queryset.db):
+        for chunk in chunked(placeholders, chunk_size):
+            bulk_update_values(queryset, (name11, name21), chunk)
+        for chunk in chunked(iter_rows(), chunk_size):
+            updated += bulk_update_values(queryset, matrix_field_names + (parent_name,), chunk)
+            written += len(chunk)
+            if progress is not None:
+                progress(written, count)
+    return updated
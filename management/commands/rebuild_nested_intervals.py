@@ -0,0 +1,42 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from nested_intervals.rebuild import rebuild_nested_intervals
+
+
+class Command(BaseCommand):
+    help = 'Recompute the nested intervals matrices of a model from its parent foreign key, and rewrite the rows that disagree.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model as app_label.ModelName.')
+        parser.add_argument(
+            '--root', action='append', type=int, dest='root_ids',
+            help='Only rebuild the tree of this root pk. Can be repeated.')
+        parser.add_argument(
+            '--batch-size', type=int, dest='batch_size', default=None,
+            help='Rows written per UPDATE statement.')
+
+    def handle(self, *args, **options):
+        try:
+            Model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not hasattr(Model, '_nested_intervals_field_names'):
+            raise CommandError('{} has no nested intervals fields.'.format(options['model']))
+
+        verbosity = options.get('verbosity', 1)
+
+        def progress(root_pk, updated):
+            if verbosity > 1:
+                self.stdout.write('Root {}: {} rows updated'.format(root_pk, updated))
+
+        report = rebuild_nested_intervals(
+            Model.objects,
+            root_ids=options['root_ids'],
+            batch_size=options['batch_size'],
+            progress=progress)
+
+        self.stdout.write('{} rows checked, {} rows updated'.format(report.checked, report.updated))
+        if report.unreachable:
+            self.stderr.write('{} rows cannot be reached from a root through their parents'.format(report.unreachable))
@@ -1,14 +1,15 @@
-from decimal import Decimal
-from pyrsistent import pvector
-import math
+from collections import namedtuple
+from fractions import Fraction
 
+from nested_intervals.exceptions import MatrixOverflowError
 
-class Matrix(object):
-    def __init__(self, a11, a12, a21, a22):
-        self.a11 = a11
-        self.a12 = a12
-        self.a21 = a21
-        self.a22 = a22
+
+class Matrix(namedtuple('Matrix', ('a11', 'a12', 'a21', 'a22'))):
+    """
+    An immutable 2x2 matrix, so it is hashable, unpacks like a tuple and
+    has no per instance __dict__.
+    """
+    __slots__ = ()
 
     def __repr__(self):
         return '{} {} {} {}'.format(self.a11, self.a12, self.a21, self.a22)
@@ -22,20 +23,18 @@ class Matrix(object):
             m1.a21 * m2.a12 + m1.a22 * m2.a22
         )
 
-    def __eq__(self, other):
-        if self.a11 != other.a11:
-            return False
-        if self.a12 != other.a12:
-            return False
-        if self.a21 != other.a21:
-            return False
-        if self.a22 != other.a22:
-            return False
-        return True
-
-    def __iter__(self):
-        for a in (self.a11, self.a12, self.a21, self.a22):
-            yield a
+    def __pow__(self, n):
+        assert n >= 0
+        result = IDENTITY_MATRIX
+        base = self
+        while n:
+            if n & 1:
+                result = result * base
+            base = base * base
+            n >>= 1
+        return result
+
+IDENTITY_MATRIX = Matrix(1, 0, 0, 1)
 
 """
 This Nested Intervals is designed such that the database table does NOT
@@ -51,22 +50,93 @@ not exist in the database.
 """
 INVISIBLE_ROOT_MATRIX = Matrix(1, -1, 1, 0)
 
-def get_child_matrix(matrix, nth_child):
+def check_matrix(matrix, max_value=None):
+    """
+    Raise MatrixOverflowError if an entry of matrix is larger than
+    max_value, the largest value the fields can store.
+    """
+    if max_value is not None and max(abs(num) for num in matrix) > max_value:
+        raise MatrixOverflowError(
+            "Matrix '{}' does not fit in fields with a maximum value of {}.".format(matrix, max_value))
+    return matrix
+
+def get_child_matrix(matrix, nth_child, max_value=None):
     """
     nth_child with value 1 repreesents the first child,
     and 2 represents the second child, etc.
     0 is an invalid nth_child value.
     """
     assert nth_child >= 1
-    return matrix * Matrix(nth_child+1, -1, 1, 0)
+    return check_matrix(matrix * Matrix(nth_child+1, -1, 1, 0), max_value)
+
+def compose_path(nths, matrix=None):
+    """
+    Same as calling get_child_matrix for every nth in turn, starting from
+    matrix, which is the invisible root by default, but without creating
+    a matrix for every step.
+    """
+    a11, a12, a21, a22 = INVISIBLE_ROOT_MATRIX if matrix is None else matrix
+    for nth_child in nths:
+        assert nth_child >= 1
+        a11, a12, a21, a22 = (
+            a11 * (nth_child+1) + a12,
+            -a11,
+            a21 * (nth_child+1) + a22,
+            -a21)
+    return Matrix(a11, a12, a21, a22)
+
+def get_nth_path(matrix):
+    """
+    The inverse of compose_path, the nths from the root down to matrix.
+    """
+    nths = []
+    a11, a12, a21, a22 = matrix
+    # Only the invisible root has a22 == 0
+    while a22 != 0:
+        nth_child = abs(a11) // abs(a12)
+        nths.append(nth_child)
+        a11, a12, a21, a22 = (
+            -a12,
+            a11 + a12 * (nth_child + 1),
+            -a22,
+            a21 + a22 * (nth_child + 1))
+    nths.reverse()
+    return tuple(nths)
+
+def get_preorder_key(matrix):
+    """
+    Sorting by this key orders nodes depth first, parents before their
+    children and siblings by nth. A node's interval shares its left bound
+    with its first child's interval but has a larger right bound.
+    """
+    a11, a12, a21, a22 = (abs(num) for num in matrix)
+    return (Fraction(a11 - a12, a21 - a22), -Fraction(a11, a21))
 
 def is_child_of_parent_matrix(child_matrix, parent_matrix):
     a11, a12, a21, a22 = child_matrix
     p11, p12, p21, p22 = parent_matrix
     return abs(a12) == p11 and abs(a22) == p21
 
+def is_descendant_of_matrix(matrix, ancestor_matrix):
+    """
+    Strict interval containment, so a matrix is not its own descendant.
+    """
+    a11, a12, a21, a22 = (abs(num) for num in matrix)
+    p11, p12, p21, p22 = (abs(num) for num in ancestor_matrix)
+    return (a11 * p21 < a21 * p11 and
+            a11 * (p21 - p22) > a21 * (p11 - p12))
+
+def get_inverse_matrix(matrix):
+    """
+    Every node matrix is a product of matrices with a determinant of 1,
+    so its inverse only has integer entries.
+    """
+    a11, a12, a21, a22 = matrix
+    assert a11 * a22 - a12 * a21 == 1, "Invalid matrix as argument."
+    return Matrix(a22, -a12, -a21, a11)
+
 def get_parent_matrix(matrix):
-    nth_child = int(math.floor(abs(Decimal(matrix.a11)) / abs(Decimal(matrix.a12))))
+    nth_child = abs(matrix.a11) // abs(matrix.a12)
     parent_matrix = Matrix(
         matrix.a11 * 0 + matrix.a12 * (-1),
         matrix.a11 * 1 + matrix.a12 * ((nth_child+1)),
@@ -76,16 +146,39 @@ def get_parent_matrix(matrix):
     assert is_child_of_parent_matrix(matrix, parent_matrix), "Invalid matrix as argument."
     return parent_matrix
 
-def _build_ancestors_matrix(matrix, l):
-    parent_matrix = get_parent_matrix(matrix)
-    if parent_matrix == INVISIBLE_ROOT_MATRIX:
-        return l
-    return _build_ancestors_matrix(parent_matrix, l.append(parent_matrix))
-
-def get_ancestors_matrix(matrix):
+def iter_ancestors_matrix(matrix, depth=None):
+    """
+    Lazily yields the parent, grandparent, etc. of matrix, excluding the
+    invisible root. At most depth ancestors are yielded if it is given.
+    """
+    a11, a12, a21, a22 = matrix
+    r11, r12, r21, r22 = INVISIBLE_ROOT_MATRIX
+    while depth is None or depth > 0:
+        nth_child = abs(a11) // abs(a12)
+        a11, a12, a21, a22 = (
+            -a12,
+            a11 + a12 * (nth_child + 1),
+            -a22,
+            a21 + a22 * (nth_child + 1))
+        if a11 == r11 and a12 == r12 and a21 == r21 and a22 == r22:
+            return
+        yield Matrix(a11, a12, a21, a22)
+        if depth is not None:
+            depth -= 1
+
+def get_ancestors_matrix(matrix, depth=None):
     # TODO
     # Rename to get_ancestors_matrices
-    return _build_ancestors_matrix(matrix, pvector())
+    return tuple(iter_ancestors_matrix(matrix, depth))
+
+def get_depth(matrix):
+    """
+    The number of ancestors of matrix, which is 0 for a root.
+    """
+    return sum(1 for ancestor in iter_ancestors_matrix(matrix))
 
 def get_root_matrix(matrix):
-    return get_ancestors_matrix(matrix)[-1]
+    root_matrix = matrix
+    for root_matrix in iter_ancestors_matrix(matrix):
+        pass
+    return root_matrix
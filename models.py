@@ -1,24 +1,46 @@
 from django.db import connection
 from django.db import models
 from django.db import transaction
-from django.db.models import Q
 from django.db.models.base import ModelBase
 from django.utils import six
 
+from nested_intervals.cache import get_cache
+from nested_intervals.cache import invalidate_cached
+from nested_intervals.capacity import get_max_value
 from nested_intervals.exceptions import NoChildrenError
 from nested_intervals.exceptions import InvalidNodeError
 from nested_intervals.managers import NestedIntervalsManager, NestedIntervalsQuerySet
 from nested_intervals.matrix import Matrix, get_child_matrix, get_ancestors_matrix, get_root_matrix
+from nested_intervals.matrix import get_depth
+from nested_intervals.matrix import get_parent_matrix
 from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import is_descendant_of_matrix
 
 from nested_intervals.queryset import get_matrix
+from nested_intervals.queryset import get_matrix_field_values
+from nested_intervals.queryset import get_signed_matrix
 from nested_intervals.queryset import get_abs_matrix
+from nested_intervals.queryset import get_node_by_matrix
 from nested_intervals.queryset import get_nth
+from nested_intervals.queryset import get_prefetched
+from nested_intervals.queryset import prefilled
 from nested_intervals.queryset import children_of
+from nested_intervals.queryset import ancestors_of_matrix
+from nested_intervals.queryset import cached_ancestors_of_matrix
 from nested_intervals.queryset import children_of_matrix
+from nested_intervals.queryset import descendants_of
+from nested_intervals.queryset import descendants_tree_of
+from nested_intervals.queryset import family_line_of
+from nested_intervals.queryset import siblings_of
+from nested_intervals.queryset import subtree_of
+from nested_intervals.queryset import iter_descendants
+from nested_intervals.queryset import PREORDER_CHUNK_SIZE
 from nested_intervals.queryset import last_child_of
 from nested_intervals.queryset import last_child_nth_of
+from nested_intervals.queryset import last_child_nths_of
 from nested_intervals.queryset import last_child_of_matrix
+from nested_intervals.queryset import matrix_keys_query
+from nested_intervals.queryset import move_descendants_of_matrix
 from nested_intervals.queryset import set_matrix
 from nested_intervals.queryset import set_parent
 
@@ -30,6 +52,7 @@ from nested_intervals.queryset import save_as_root
 
 from nested_intervals.queryset import reroot
 
+from nested_intervals.utils import chunked
 from nested_intervals.validation import validate_node
 
 from sql import Literal
@@ -37,7 +60,7 @@ from sql import Null
 from sql import Table
 
 from functools import reduce
-from itertools import imap, izip, tee
+from itertools import izip, tee
 
 try:
     from collections import ChainMap
@@ -66,52 +89,66 @@ class NestedIntervalsModelMixin(models.Model):
         return get_abs_matrix(self)
 
     def get_root(self):
-        return self.__class__.objects.get(
-            **self.__class__.build_nested_intervals_query_kwargs(
-                *get_root_matrix(self.get_matrix())))
+        return get_node_by_matrix(self.__class__, get_root_matrix(self.get_matrix()))
 
     def get_parent(self):
-        name11, name12, name21, name22, parent_name = self._nested_intervals_field_names
-        return self.__class__.objects.get(**{
-            name11: getattr(self, name12),
-            name21: getattr(self, name22)
-        })
+        return get_node_by_matrix(self.__class__, get_parent_matrix(self.get_matrix()))
 
     def get_ancestors_query(self):
-        return reduce(
-            lambda a, b: a | Q(**self.__class__.build_nested_intervals_query_kwargs(*b)),
-            get_ancestors_matrix(self.get_matrix()),
-            Q())
+        # An ancestor is fully determined by its (a11, a21) pair.
+        name11, name12, name21, name22, parent_name = self._nested_intervals_field_names
+        return matrix_keys_query(name11, name21, (
+            (abs(a11), abs(a21))
+            for a11, a12, a21, a22 in get_ancestors_matrix(self.get_matrix())))
 
     def get_ancestors(self):
-        query = self.get_ancestors_query()
-        if query:
-            return self.__class__.objects.filter(query)
-        return self.__class__.objects.none()
+        """
+        Ordered from the parent up to the root, whether the ancestors are
+        queried, prefetched or cached.
+        """
+        ancestors = get_prefetched(self, 'ancestors')
+        if ancestors is not None:
+            return prefilled(ancestors_of_matrix(self.__class__.objects, self.get_matrix()), ancestors)
+        if get_cache(self.__class__) is None:
+            return ancestors_of_matrix(self.__class__.objects, self.get_matrix())
+        return cached_ancestors_of_matrix(self.__class__.objects, self.get_matrix())
 
     def get_children(self):
+        children = get_prefetched(self, ('descendants', 1))
+        if children is not None:
+            return prefilled(children_of(self), children)
         return children_of(self)
 
-    def get_descendants(self):
-        name11, name12, name21, name22, parent_name = self._nested_intervals_field_names
-        a11, a12, a21, a22 = self.get_abs_matrix()
+    def get_descendants(self, max_depth=None):
+        descendants = get_prefetched(self, ('descendants', max_depth))
+        if descendants is not None:
+            return prefilled(descendants_of(self, max_depth), descendants)
+        return descendants_of(self, max_depth)
 
-        s1 = a11 - a12 # 's' stands for sibling
-        s2 = a21 - a22
+    def get_depth(self):
+        return get_depth(self.get_matrix())
 
-        return self.__class__.objects.extra(
-            where=[
-                "({} * %s) >= (%s * {})".format(name11, name21),
-                "({} * %s) <= (%s * {})".format(name12, name22)
-            ],
-            params=[s2, s1, a21, a11])
+    def get_descendants_tree(self, max_depth=None):
+        return descendants_tree_of(self, max_depth)
+
+    def iter_descendants(self, chunk_size=PREORDER_CHUNK_SIZE):
+        return iter_descendants(self, chunk_size)
 
     def get_family_line(self):
         """
         This includes self, ancestors, and descendants.
         This EXCLUDES siblings and cousins.
         """
-        return self.get_ancestors() | self.get_descendants() | self.__class__.objects.filter(pk=self.pk)
+        return family_line_of(self)
+
+    def get_siblings(self, include_self=False):
+        return siblings_of(self, include_self)
+
+    def get_subtree(self):
+        """
+        This includes self and descendants.
+        """
+        return subtree_of(self)
 
     def set_matrix(self, matrix):
         set_matrix(self, matrix)
@@ -152,11 +189,10 @@ def clean_nested_intervals_by_parent_id(Model, parent_id=None, i=0):
 
     child_matrix = get_child_matrix(
         parent_matrix,
-        last_child_nth_of(Model.objects, parent_matrix) + i + 1
+        last_child_nth_of(Model.objects, parent_matrix) + i + 1,
+        get_max_value(Model)
     )
-    return dict(izip(
-        Model._nested_intervals_field_names[0:-1],
-        imap(abs, child_matrix)))
+    return get_matrix_field_values(Model, child_matrix)
 
 def clean_nested_intervals(Model, d, i=0):
     try:
@@ -183,6 +219,7 @@ def created_instances(Model, multi_column_values):
         instance.save()
         yield instance.pk
 
+@transaction.atomic
 def create(Model, allowed_columns, multi_column_values):
     table = Table(Model._meta.db_table)
     validate_multi_column_values(multi_column_values, allowed_columns)
@@ -194,6 +231,20 @@ def update(Model, allowed_columns, pk_column_value, column_values):
     for column, value in column_values.iteritems():
         assert column in allowed_columns, "'{}' is not set as allowed".format(column)
 
+    # Updating a node's parent should result in
+    # updating of the node's descendants, which are
+    # found by the node's matrix before the update.
+
+    try:
+        parent_name = Model._nested_intervals_field_names[-1]
+    except AttributeError:
+        old_matrix = None
+    else:
+        if parent_name+'_id' in column_values:
+            old_matrix = get_matrix(Model.objects.get(**pk_column_value))
+        else:
+            old_matrix = None
+
     table = Table(Model._meta.db_table)
 
     cvalues1, cvalues2  = tee(clean_default(Model, column_values).iteritems())
@@ -218,23 +269,112 @@ def update(Model, allowed_columns, pk_column_value, column_values):
         ))
         assert cursor.rowcount == 1, 'Expect only 1 SQL Update. Got {} instead. pk_column_value={}'.format(cursor.rowcount, pk_column_value)
 
-    # Updating a node's parent should result in
-    # updating of the node's descendants.
-
+    instance = Model.objects.get(**pk_column_value)
+
+    if old_matrix is not None:
+        new_matrix = get_matrix(instance)
+        if is_descendant_of_matrix(new_matrix, old_matrix):
+            raise InvalidNodeError("'{}({})' cannot become a descendant of itself.".format(Model.__name__, instance.pk))
+        move_descendants_of_matrix(Model.objects, old_matrix, new_matrix)
+    elif hasattr(Model, '_nested_intervals_field_names'):
+        # The UPDATE bypasses post_save
+        name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+        invalidate_cached(Model, getattr(instance, name11), getattr(instance, name21))
+    return instance.pk
+
+def parent_matrices_by_id(Model, parent_ids):
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    matrices = {}
+    for chunk in chunked(set(parent_ids)):
+        for pk, v11, v12, v21, v22 in Model.objects.filter(pk__in=chunk).values_list(
+                'pk', name11, name12, name21, name22):
+            matrices[pk] = get_signed_matrix((v11, v12, v21, v22))
+    return matrices
+
+def bulk_cleaned_nested_intervals(Model, multi_column_values):
+    """
+    Same as clean_nested_intervals applied to every row, except that all
+    parents and their last child nth are fetched with one query each, and
+    siblings created together are numbered consecutively in input order.
+    """
     try:
         parent_name = Model._nested_intervals_field_names[-1]
     except AttributeError:
-        pass
-    else:
-        if parent_name+'_id' in column_values:
-            parent_id = Model.objects.get(**pk_column_value).pk
-            id_filter = {
-                parent_name+'__'+key: value
-                for key, value in pk_column_value.iteritems()
-            }
-            children = Model.objects.filter(**id_filter).iterator()
-            for child in children:
-                update(Model, allowed_columns, {Model._meta.pk.name: child.pk}, {
-                    parent_name+'_id': parent_id,
-                })
-    return Model.objects.get(**pk_column_value).pk
+        for d in multi_column_values:
+            yield {}
+        return
+    parent_ids = [
+        d.get(parent_name+'_id')
+        for d in multi_column_values
+    ]
+    parent_matrices = parent_matrices_by_id(Model, (i for i in parent_ids if i))
+    for parent_id in parent_ids:
+        if parent_id and parent_id not in parent_matrices:
+            raise Model.DoesNotExist('{} matching parent_id={} does not exist.'.format(Model.__name__, parent_id))
+
+    last_nths = last_child_nths_of(
+        Model.objects,
+        tuple(parent_matrices.values()) + (INVISIBLE_ROOT_MATRIX,))
+    max_value = get_max_value(Model)
+
+    for d, parent_id in izip(multi_column_values, parent_ids):
+        if parent_name+'_id' not in d:
+            yield {}
+            continue
+
+        parent_matrix = parent_matrices[parent_id] if parent_id else INVISIBLE_ROOT_MATRIX
+        key = (abs(parent_matrix.a11), abs(parent_matrix.a21))
+        last_nths[key] += 1
+
+        yield get_matrix_field_values(
+            Model,
+            get_child_matrix(parent_matrix, last_nths[key], max_value))
+
+def created_pks(Model, instances):
+    """
+    Backends that do not return primary keys from bulk_create leave
+    instance.pk unset, so look them up by their unique (a11, a21) pair.
+    Models without nested intervals have no such pair, and keep None.
+    """
+    try:
+        name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    except AttributeError:
+        return tuple(instance.pk for instance in instances)
+    missing = [instance for instance in instances if instance.pk is None]
+
+    for chunk in chunked(missing):
+        keys = dict(
+            ((getattr(instance, name11), getattr(instance, name21)), instance)
+            for instance in chunk)
+        assert None not in (key for pair in keys for key in pair), 'Primary keys of rows created without a parent_id cannot be looked up.'
+
+        for v11, v21, pk in Model.objects.filter(**{
+                name11+'__in': set(v11 for v11, v21 in keys),
+                name21+'__in': set(v21 for v11, v21 in keys),
+                }).values_list(name11, name21, 'pk'):
+            if (v11, v21) in keys:
+                keys[(v11, v21)].pk = pk
+
+    return tuple(instance.pk for instance in instances)
+
+@transaction.atomic
+def bulk_create(Model, allowed_columns, multi_column_values, batch_size=None):
+    """
+    Bulk version of create for importing many rows. Returns the primary
+    keys in the same order as multi_column_values, which are None for
+    models without nested intervals on backends that do not return them.
+    """
+    validate_multi_column_values(multi_column_values, allowed_columns)
+
+    instances = []
+    for d, nested_intervals in izip(
+            multi_column_values,
+            bulk_cleaned_nested_intervals(Model, multi_column_values)):
+        instance = Model()
+        for field, value in ChainMap(d, nested_intervals).iteritems():
+            setattr(instance, field, value)
+        assert instance.pk is None, 'Primary key of {} should not be set before save because you intend to create, but you are updating instead.'.format(Model.__name__)
+        instances.append(instance)
+
+    Model.objects.bulk_create(instances, batch_size=batch_size)
+    return created_pks(Model, instances)
@@ -1,36 +1,107 @@
+from django.db import IntegrityError
+from django.db import OperationalError
+from django.db import connections
 from django.db import models
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import ExpressionWrapper
 from django.db.models import F
+from django.db.models import FloatField
+from django.db.models import Func
+from django.db.models import Max
+from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
 
+from nested_intervals.cache import get_cached
+from nested_intervals.cache import get_cached_many
+from nested_intervals.cache import invalidate_cache
+from nested_intervals.cache import invalidate_cached
+from nested_intervals.cache import set_cached
+from nested_intervals.cache import set_cached_many
+from nested_intervals.capacity import get_max_value
 from nested_intervals.exceptions import InvalidNodeError
+from nested_intervals.matrix import check_matrix
+from nested_intervals.matrix import get_ancestors_matrix
 from nested_intervals.matrix import get_child_matrix
+from nested_intervals.matrix import get_depth
+from nested_intervals.matrix import get_inverse_matrix
+from nested_intervals.matrix import get_preorder_key
+from nested_intervals.matrix import is_descendant_of_matrix
 from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
 from nested_intervals.matrix import Matrix
 from nested_intervals.exceptions import NoChildrenError
+from nested_intervals.tree import build_tree
+from nested_intervals.utils import chunked
 from nested_intervals.validation import validate_node
 
-import functools
+from functools import reduce
 import operator
+import random
+import time
 
 ######################
 # INSTANCE FUNCTIONS #
 ######################
 
-def get_matrix(instance):
+def get_signed_matrix(abs_values):
+    # int() because decimal storage returns Decimal values
     return Matrix(*(
-        getattr(instance, field_name) * (1 if (i % 2 == 0) else -1)
-        for i, field_name in enumerate(instance._nested_intervals_field_names[0:-1]))
+        int(num) * (1 if (i % 2 == 0) else -1)
+        for i, num in enumerate(abs_values))
     )
 
+def get_matrix(instance):
+    return get_signed_matrix(
+        getattr(instance, field_name)
+        for field_name in instance._nested_intervals_field_names[0:-1])
+
 def get_abs_matrix(instance):
     return Matrix(*tuple(abs(num) for num in get_matrix(instance)))
 
+def get_nth_from_a11(a11, parent_a11):
+    # The nth child's a11 is parent_a11 * (nth + 1) - abs(parent_a12),
+    # where 0 < abs(parent_a12) <= parent_a11.
+    return int(a11) // int(parent_a11)
+
 def get_nth(instance):
     n11, n12, n21, n22, parent_name = instance._nested_intervals_field_names
     return int(getattr(instance, n11) / getattr(instance, n12))
 
+def get_interval(matrix):
+    """
+    The left and right bounds of the interval of matrix. The right bound
+    of every descendant lies strictly between them.
+    """
+    a11, a12, a21, a22 = (abs(num) for num in matrix)
+    return (float(a11 - a12) / (a21 - a22), float(a11) / a21)
+
+def get_matrix_field_names(Model):
+    interval_field_names = Model._nested_intervals_interval_field_names or ()
+    depth_field_name = Model._nested_intervals_depth_field_name
+    return (
+        tuple(Model._nested_intervals_field_names[0:-1])
+        + tuple(interval_field_names)
+        + ((depth_field_name,) if depth_field_name else ()))
+
+def get_matrix_field_values(Model, matrix):
+    """
+    The values of every field that is derived from the matrix.
+    """
+    values = tuple(abs(num) for num in matrix)
+    if Model._nested_intervals_interval_field_names:
+        values += get_interval(matrix)
+    if Model._nested_intervals_depth_field_name:
+        values += (get_depth(matrix),)
+    return dict(zip(get_matrix_field_names(Model), values))
+
 def set_matrix(instance, matrix):
-    for field_name, num in zip(instance._nested_intervals_field_names, matrix):
-        setattr(instance, field_name, abs(num))
+    name11, name12, name21, name22, parent_name = instance._nested_intervals_field_names
+    invalidate_cached(type(instance), getattr(instance, name11), getattr(instance, name21))
+    invalidate_cached(type(instance), matrix[0], matrix[2])
+
+    for field_name, value in get_matrix_field_values(type(instance), matrix).iteritems():
+        setattr(instance, field_name, value)
 
 def set_parent(instance, parent):
     parent_name = instance._nested_intervals_field_names[-1]
@@ -43,7 +114,8 @@ def set_as_child_of(instance, parent):
         parent_matrix = INVISIBLE_ROOT_MATRIX
     child_matrix = get_child_matrix(
         parent_matrix,
-        last_child_nth_of(type(instance).objects, parent_matrix) + 1)
+        last_child_nth_of(type(instance).objects, parent_matrix) + 1,
+        get_max_value(type(instance)))
 
     try:
         validate_node(instance)
@@ -61,22 +133,186 @@ def set_as_child_of(instance, parent):
 
 def save_as_child_of(instance, parent, *args, **kwargs):
     nodes = set_as_child_of(instance, parent)
-    for node in nodes:
-        node.save(*args, **kwargs)
+    with transaction.atomic():
+        instance.save(*args, **kwargs)
+        bulk_update(
+            type(instance).objects,
+            nodes[1:],
+            get_matrix_field_names(type(instance)) + instance._nested_intervals_field_names[-1:])
     return nodes
 
+def locked_save_as_child_of(instance, parent, *args, **kwargs):
+    """
+    save_as_child_of for a new instance, safe against concurrent inserts
+    under the same parent.
+
+    Where the database supports SELECT ... FOR UPDATE, the parent row is
+    locked until the transaction ends, which serializes slot allocation
+    per parent. Elsewhere, and for roots which have no parent row, two
+    inserts that computed the same slot collide on the unique (a11, a21)
+    index (register_fields with indexes=True), and the loser retries with
+    the next free slot. SQLite reports colliding writers as a locked
+    database, which is retried the same way.
+
+    max_retries, 10 by default, is keyword only, as the other arguments
+    are passed to save().
+    """
+    max_retries = kwargs.pop('max_retries', 10)
+    assert instance.pk is None, 'Only new instances can be inserted.'
+    Model = type(instance)
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    assert (name11, name21) in Model._meta.unique_together, (
+        "'{}' needs the unique ({}, {}) index of register_fields with indexes=True.".format(
+            Model.__name__, name11, name21))
+
+    for attempt in xrange(max_retries):
+        try:
+            with transaction.atomic(using=Model.objects.db):
+                if parent and connections[Model.objects.db].features.has_select_for_update:
+                    list(Model.objects.select_for_update().filter(pk=parent.pk).values_list('pk'))
+                return save_as_child_of(instance, parent, *args, **kwargs)
+        except (IntegrityError, OperationalError):
+            instance.pk = None
+            if attempt == max_retries - 1:
+                raise
+            time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+
 def set_as_root(instance):
     return set_as_child_of(instance, None)
 
 def save_as_root(instance, *args, **kwargs):
-    set_as_root(instance)
-    instance.save(*args, **kwargs)
+    # Also saves the descendants of an existing instance
+    save_as_child_of(instance, None, *args, **kwargs)
     return instance
 
 ######################
 # QUERYSET FUNCTIONS #
 ######################
 
+# Every interval lies within (0, 1), where this is far more than
+# the rounding error of a double.
+INTERVAL_EPSILON = 1e-12
+
+def interval_expressions(name11, name12, name21, name22):
+    """
+    SQL expressions of the left and right bounds of the interval, given
+    expressions of the four matrix fields.
+    """
+    return (
+        ExpressionWrapper((name11 - name12) * 1.0 / (name21 - name22), output_field=FloatField()),
+        ExpressionWrapper(name11 * 1.0 / name21, output_field=FloatField()))
+
+def update_intervals(queryset):
+    """
+    Fill the interval fields from the matrix fields in one UPDATE,
+    e.g. after adding interval_fields to an existing model.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    left_name, right_name = queryset.model._nested_intervals_interval_field_names
+    left, right = interval_expressions(F(name11), F(name12), F(name21), F(name22))
+    return queryset.update(**{left_name: left, right_name: right})
+
+def supports_row_values(connection):
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 15, 0)
+    return connection.vendor in ('postgresql', 'mysql', 'oracle')
+
+def needs_bigint_cast(connection, field):
+    # PostgreSQL multiplies integer columns in 32 bits, SQLite and MySQL in 64
+    return connection.vendor == 'postgresql' and field.get_internal_type() in (
+        'IntegerField', 'PositiveIntegerField', 'SmallIntegerField', 'PositiveSmallIntegerField')
+
+def bigint_sql(connection, Model, name, sql=None):
+    """
+    sql, by default the column of the field name, cast to bigint where the
+    database would compute its products in fewer bits. See capacity.
+    """
+    if sql is None:
+        sql = Model._meta.get_field(name).column
+    if needs_bigint_cast(connection, Model._meta.get_field(name)):
+        return 'CAST({} AS BIGINT)'.format(sql)
+    return sql
+
+def bigint_expression(connection, Model, name):
+    """
+    Same as bigint_sql, as an expression.
+    """
+    field = Model._meta.get_field(name)
+    if needs_bigint_cast(connection, field):
+        # The output_field of the column, which the other operands share
+        return Func(F(name), template='CAST(%(expressions)s AS BIGINT)', output_field=field)
+    return F(name)
+
+def supports_simultaneous_update(connection):
+    # MySQL evaluates SET assignments left to right, using updated values
+    return connection.vendor != 'mysql'
+
+def matrix_keys_query(name_a, name_b, keys):
+    return reduce(
+        operator.or_,
+        (Q(**{name_a: a, name_b: b}) for a, b in keys),
+        Q())
+
+def balanced_or(conditions):
+    """
+    conditions joined with OR in a balanced tree of parentheses, so the
+    expression depth is logarithmic instead of linear in their number.
+    """
+    if len(conditions) == 1:
+        return conditions[0]
+    middle = len(conditions) // 2
+    return '({} OR {})'.format(balanced_or(conditions[:middle]), balanced_or(conditions[middle:]))
+
+def matrix_keys_where(connection, name_a, name_b, keys):
+    """
+    SQL and params of the predicate of matrix_keys_filter.
+
+    The keys are integers computed from matrices, and are inlined instead of
+    passed as params, so that deep trees stay below the parameter limit of
+    SQLite (999 before 3.32).
+    """
+    keys = [(int(a), int(b)) for a, b in keys]
+    if supports_row_values(connection):
+        # SQLite does not search an index for a row value IN list, but
+        # does for the separate IN lists, which select a superset.
+        sql = "{a} IN ({in_a}) AND {b} IN ({in_b}) AND ({a}, {b}) IN ({pairs})".format(
+            a=name_a,
+            b=name_b,
+            in_a=', '.join(str(a) for a in sorted(set(a for a, b in keys))),
+            in_b=', '.join(str(b) for b in sorted(set(b for a, b in keys))),
+            pairs=', '.join('({}, {})'.format(a, b) for a, b in keys))
+        return sql, []
+
+    # A flat OR chain of a deep node's ancestors exceeds the expression
+    # depth limit of SQLite (1000)
+    return balanced_or([
+        '({} = {} AND {} = {})'.format(name_a, a, name_b, b)
+        for a, b in keys]), []
+
+def matrix_keys_filter(queryset, name_a, name_b, keys):
+    """
+    Filter rows whose (name_a, name_b) pair is one of keys, with a single
+    (name_a, name_b) IN ((..), (..)) predicate, or a balanced OR of pairs
+    where row values are not supported.
+    """
+    keys = tuple(set(keys))
+    if not keys:
+        return queryset.none()
+
+    sql, params = matrix_keys_where(connections[queryset.db], name_a, name_b, keys)
+    return queryset.extra(where=[sql], params=params)
+
+def ancestors_of_matrix(queryset, matrix):
+    """
+    The ancestors of matrix ordered from the parent up to the root, the
+    same order as ancestors_of_many and cached_ancestors_of_matrix. a21
+    grows from every node to its children, so it orders a family line.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    return matrix_keys_filter(queryset, name11, name21, (
+        (abs(a11), abs(a21))
+        for a11, a12, a21, a22 in get_ancestors_matrix(matrix))).order_by('-'+name21)
+
 def children_of_matrix(queryset, matrix):
     name11, name12, name21, name22 = queryset.model._nested_intervals_field_names[0:4]
     parent_value11, parent_value12, parent_value21, parent_value22 = matrix
@@ -99,6 +335,483 @@ def children_of(parent, queryset=None):
         name22: parent_value21
     })
 
+def nodes_by_keys(queryset, name_a, name_b, keys):
+    """
+    Rows of queryset whose (name_a, name_b) pair is one of keys, as lists
+    keyed by the pair, with one query per chunk of keys.
+    """
+    by_key = {}
+    for chunk in chunked(set(keys)):
+        for node in matrix_keys_filter(queryset, name_a, name_b, chunk):
+            by_key.setdefault((getattr(node, name_a), getattr(node, name_b)), []).append(node)
+    return by_key
+
+def children_of_many(queryset, nodes):
+    """
+    Returns the children of every node in nodes, sorted by nth, in a dict
+    keyed by the node.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    keys = dict(
+        (node, (getattr(node, name11), getattr(node, name21)))
+        for node in nodes)
+    children = nodes_by_keys(queryset, name12, name22, keys.values())
+    return dict(
+        (node, sorted(children.get(key, ()), key=get_nth))
+        for node, key in keys.iteritems())
+
+def parents_of_many(queryset, nodes):
+    """
+    Returns the parent of every node in nodes, or None for roots, in a
+    dict keyed by the node.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    keys = dict(
+        (node, (getattr(node, name12), getattr(node, name22)))
+        for node in nodes)
+    parents = nodes_by_keys(queryset, name11, name21, keys.values())
+    return dict(
+        (node, parents.get(key, (None,))[0])
+        for node, key in keys.iteritems())
+
+def ancestors_of_many(queryset, nodes):
+    """
+    Returns the ancestors of every node in nodes, from its parent up to
+    its root, in a dict keyed by the node.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    keys = dict(
+        (node, [
+            (abs(a11), abs(a21))
+            for a11, a12, a21, a22 in get_ancestors_matrix(node.get_matrix())])
+        for node in nodes)
+    ancestors = nodes_by_keys(queryset, name11, name21, (
+        key
+        for node_keys in keys.values()
+        for key in node_keys))
+    return dict(
+        (node, [ancestors[key][0] for key in node_keys if key in ancestors])
+        for node, node_keys in keys.iteritems())
+
+def descendants_where(queryset, matrix):
+    """
+    SQL conditions and params of the exact predicate of descendants_of_matrix.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    a11, a12, a21, a22 = (abs(v) for v in matrix)
+
+    s1 = a11 - a12 # 's' stands for sibling
+    s2 = a21 - a22
+
+    # Descendants never have a smaller a11 or a21, which bounds
+    # the rows to check with the (a21, a11) index.
+    conditions = [
+        "{} > %s".format(name21),
+        "{} >= %s".format(name11),
+        "({} * %s) >= (%s * {})".format(*bigint_names(queryset, name11, name21)),
+        "({} * %s) <= (%s * {})".format(*bigint_names(queryset, name12, name22)),
+    ]
+    return conditions, [a21, a11, s2, s1, a21, a11]
+
+def descendants_of_matrix(queryset, matrix):
+    interval_field_names = queryset.model._nested_intervals_interval_field_names
+
+    if interval_field_names:
+        # An indexed range scan over the stored right bounds, widened so
+        # that float rounding never leaves a descendant out. The exact
+        # integer predicate below removes the extra rows.
+        left, right = get_interval(matrix)
+        left_name, right_name = interval_field_names
+        queryset = queryset.filter(**{
+            right_name+'__gt': left - INTERVAL_EPSILON,
+            right_name+'__lt': right + INTERVAL_EPSILON,
+        })
+
+    conditions, params = descendants_where(queryset, matrix)
+    return queryset.extra(where=conditions, params=params)
+
+def bigint_names(queryset, *names):
+    connection = connections[queryset.db]
+    return [bigint_sql(connection, queryset.model, name) for name in names]
+
+def subtree_where(queryset, matrix):
+    """
+    SQL conditions and params that select the node with matrix and its
+    descendants: the rows whose right bound x = a11 / a21 lies in
+    (left, right] of matrix's interval, compared by cross multiplication.
+    With interval fields, the same widened range scan as
+    descendants_of_matrix comes first.
+    """
+    Model = queryset.model
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    interval_field_names = Model._nested_intervals_interval_field_names
+    a11, a12, a21, a22 = (abs(v) for v in matrix)
+
+    conditions = []
+    params = []
+    if interval_field_names:
+        left, right = get_interval(matrix)
+        left_name, right_name = interval_field_names
+        conditions += ["{} > %s".format(right_name), "{} < %s".format(right_name)]
+        params += [left - INTERVAL_EPSILON, right + INTERVAL_EPSILON]
+
+    conditions += [
+        "{} >= %s".format(name21),
+        "{} >= %s".format(name11),
+        "({} * %s) > (%s * {})".format(*bigint_names(queryset, name11, name21)),
+        "({} * %s) <= (%s * {})".format(*bigint_names(queryset, name11, name21)),
+    ]
+    params += [a21, a11, a21 - a22, a11 - a12, a21, a11]
+    return conditions, params
+
+def subtree_of_matrix(queryset, matrix):
+    """
+    The node with matrix and its descendants.
+    """
+    conditions, params = subtree_where(queryset, matrix)
+    return queryset.extra(where=conditions, params=params)
+
+def subtree_of(node, queryset=None):
+    if queryset is None:
+        queryset = type(node).objects
+    return subtree_of_matrix(queryset, node.get_matrix())
+
+def family_line_of(node, queryset=None):
+    """
+    node, its ancestors and its descendants with one predicate: the
+    subtree conditions of node, or an ancestor's (a11, a21) pair, where
+    the pairs are computed from node's matrix. Both branches are
+    searched with an index.
+    """
+    if queryset is None:
+        queryset = type(node).objects
+    name11, name12, name21, name22, parent_name = node._nested_intervals_field_names
+    matrix = node.get_matrix()
+
+    conditions, params = subtree_where(queryset, matrix)
+    where = '({})'.format(' AND '.join(conditions))
+
+    keys = tuple((abs(a11), abs(a21)) for a11, a12, a21, a22 in get_ancestors_matrix(matrix))
+    if keys:
+        keys_where, keys_params = matrix_keys_where(connections[queryset.db], name11, name21, keys)
+        where = '{} OR ({})'.format(where, keys_where)
+        params += keys_params
+
+    return queryset.extra(where=[where], params=params)
+
+def siblings_of(node, include_self=False, queryset=None):
+    """
+    The other children of node's parent, which share its (a12, a22).
+    """
+    if queryset is None:
+        queryset = type(node).objects
+    name11, name12, name21, name22, parent_name = node._nested_intervals_field_names
+    a11, a12, a21, a22 = node.get_abs_matrix()
+
+    siblings = queryset.filter(**{name12: a12, name22: a22})
+    if include_self:
+        return siblings
+    return siblings.exclude(pk=node.pk)
+
+def descendants_of(node, max_depth=None, queryset=None):
+    """
+    The descendants of node, or only those at most max_depth levels below
+    node, which needs the depth field.
+    """
+    if queryset is None:
+        queryset = type(node).objects
+    descendants = descendants_of_matrix(queryset, node.get_matrix())
+    if max_depth is None:
+        return descendants
+
+    depth_field_name = queryset.model._nested_intervals_depth_field_name
+    assert depth_field_name, "{} has no 'depth_field'.".format(queryset.model.__name__)
+    return descendants.filter(**{depth_field_name+'__lte': get_depth(node.get_matrix()) + max_depth})
+
+def at_depth(queryset, depth):
+    """
+    The nodes with depth ancestors, where roots are at depth 0.
+    """
+    depth_field_name = queryset.model._nested_intervals_depth_field_name
+    assert depth_field_name, "{} has no 'depth_field'.".format(queryset.model.__name__)
+    return queryset.filter(**{depth_field_name: depth})
+
+def move_descendants_of_matrix(queryset, old_matrix, new_matrix):
+    """
+    Make every descendant of old_matrix the same descendant of new_matrix,
+    with one UPDATE statement.
+
+    A descendant's matrix is old_matrix * X for some path matrix X, so
+    left multiplying it by new_matrix * old_matrix^-1 gives new_matrix * X.
+    The abs values stored in the fields transform the same way as the
+    signed matrix, because every column has a positive and a negative entry.
+
+    The UPDATE reads all four fields before writing any of them, which holds
+    for SQLite and PostgreSQL but not for MySQL, where MySQL assigns left to
+    right and later fields would read already updated values. On MySQL the
+    descendants are moved with bulk_move_descendants_of_matrix instead.
+
+    Raises MatrixOverflowError, before anything is written, if a moved
+    value would be larger than the fields can store.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    interval_field_names = queryset.model._nested_intervals_interval_field_names
+    t11, t12, t21, t22 = new_matrix * get_inverse_matrix(old_matrix)
+    descendants = descendants_of_matrix(queryset, old_matrix)
+
+    connection = connections[queryset.db]
+    f11, f12, f21, f22 = (
+        bigint_expression(connection, queryset.model, name)
+        for name in (name11, name12, name21, name22))
+    new_values = {
+        name11: f11 * t11 + f21 * t12,
+        name12: f12 * t11 + f22 * t12,
+        name21: f11 * t21 + f21 * t22,
+        name22: f12 * t21 + f22 * t22,
+    }
+    max_value = get_max_value(queryset.model)
+    if max_value is not None:
+        largest = descendants.aggregate(**dict(
+            (name, Max(value)) for name, value in new_values.iteritems()))
+        check_matrix([value or 0 for value in largest.values()], max_value)
+
+    if not supports_simultaneous_update(connections[queryset.db]):
+        return bulk_move_descendants_of_matrix(queryset, old_matrix, new_matrix)
+
+    if interval_field_names:
+        # Computed from the new values, as the fields are read before any is written
+        new_values.update(zip(interval_field_names, interval_expressions(
+            new_values[name11], new_values[name12], new_values[name21], new_values[name22])))
+    depth_field_name = queryset.model._nested_intervals_depth_field_name
+    if depth_field_name:
+        new_values[depth_field_name] = F(depth_field_name) + (get_depth(new_matrix) - get_depth(old_matrix))
+
+    invalidate_cache(queryset.model)
+    return descendants.update(**new_values)
+
+def bulk_move_descendants_of_matrix(queryset, old_matrix, new_matrix):
+    """
+    Same as move_descendants_of_matrix, with the new matrices computed in
+    Python and written with bulk_update_values, for backends whose UPDATE
+    does not read every field before writing any of them.
+    """
+    Model = queryset.model
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    transform = new_matrix * get_inverse_matrix(old_matrix)
+    max_value = get_max_value(Model)
+    field_names = get_matrix_field_names(Model)
+
+    def rows():
+        for pk, v11, v12, v21, v22 in descendants_of_matrix(queryset, old_matrix).values_list(
+                'pk', name11, name12, name21, name22).iterator():
+            values = get_matrix_field_values(
+                Model, check_matrix(transform * get_signed_matrix((v11, v12, v21, v22)), max_value))
+            yield pk, tuple(values[name] for name in field_names)
+
+    invalidate_cache(Model)
+    return bulk_update_values(queryset, field_names, rows())
+
+def get_node_by_matrix(Model, matrix):
+    """
+    The node with matrix, from the cache of Model if it has one.
+    """
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    a11, a12, a21, a22 = (abs(v) for v in matrix)
+
+    node = get_cached(Model, a11, a21)
+    if node is None:
+        node = Model.objects.get(**{name11: a11, name21: a21})
+        set_cached(node)
+    return node
+
+def prefilled(queryset, instances):
+    """
+    queryset evaluated to instances without a query, the same way
+    prefetch_related fills querysets.
+    """
+    queryset._result_cache = list(instances)
+    queryset._prefetch_done = True
+    return queryset
+
+def cached_ancestors_of_matrix(queryset, matrix):
+    """
+    Same as ancestors_of_matrix, but evaluated, from the cache of the model
+    when every ancestor is cached. Ordered from the parent up to the root,
+    as the query is.
+    """
+    Model = queryset.model
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    keys = tuple((abs(a11), abs(a21)) for a11, a12, a21, a22 in get_ancestors_matrix(matrix))
+
+    nodes = get_cached_many(Model, keys)
+    if any(node is None for node in nodes):
+        by_key = dict(
+            ((getattr(node, name11), getattr(node, name21)), node)
+            for node in ancestors_of_matrix(queryset, matrix))
+        nodes = [by_key[key] for key in keys if key in by_key]
+        set_cached_many(nodes)
+    return prefilled(ancestors_of_matrix(queryset, matrix), nodes)
+
+def get_prefetched(node, name):
+    """
+    The nodes prefetched by NestedIntervalsQuerySet under name, or None.
+    """
+    return getattr(node, '_nested_intervals_prefetched', {}).get(name)
+
+def set_prefetched(node, name, nodes):
+    if not hasattr(node, '_nested_intervals_prefetched'):
+        node._nested_intervals_prefetched = {}
+    node._nested_intervals_prefetched[name] = nodes
+
+def prefetch_ancestors(queryset, nodes):
+    for node, ancestors in ancestors_of_many(queryset, nodes).iteritems():
+        set_prefetched(node, 'ancestors', ancestors)
+
+# Every node adds 6 params to the query of its chunk, which stays below
+# the 999 of older SQLite
+DESCENDANTS_CHUNK_SIZE = 100
+
+def descendants_of_many(queryset, nodes, max_depth=None):
+    """
+    Returns the descendants of every node in nodes, at most max_depth
+    levels below it, in a dict keyed by the node.
+
+    Every chunk of nodes takes one query, for the union of their
+    intervals with interval fields, or else for the OR of their
+    descendants predicates. Each row is matched to the nodes among its
+    ancestors.
+    """
+    Model = queryset.model
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    interval_field_names = Model._nested_intervals_interval_field_names
+    depth_field_name = Model._nested_intervals_depth_field_name
+    descendants = dict((node, []) for node in nodes)
+
+    for chunk in chunked(nodes, DESCENDANTS_CHUNK_SIZE):
+        by_key = dict(((getattr(node, name11), getattr(node, name21)), node) for node in chunk)
+        if interval_field_names:
+            left_name, right_name = interval_field_names
+            rows = queryset.filter(reduce(operator.or_, (
+                Q(**{
+                    right_name+'__gt': left - INTERVAL_EPSILON,
+                    right_name+'__lt': right + INTERVAL_EPSILON,
+                })
+                for left, right in (get_interval(node.get_matrix()) for node in chunk))))
+        else:
+            wheres = []
+            params = []
+            for node in chunk:
+                conditions, node_params = descendants_where(queryset, node.get_matrix())
+                wheres.append('({})'.format(' AND '.join(conditions)))
+                params += node_params
+            rows = queryset.extra(where=[balanced_or(wheres)], params=params)
+        if max_depth is not None and depth_field_name:
+            rows = rows.filter(**{
+                depth_field_name+'__lte': max(get_depth(node.get_matrix()) for node in chunk) + max_depth})
+
+        for row in rows:
+            for ancestor_matrix in get_ancestors_matrix(row.get_matrix(), max_depth):
+                node = by_key.get((abs(ancestor_matrix.a11), abs(ancestor_matrix.a21)))
+                if node is not None:
+                    descendants[node].append(row)
+
+    for node_descendants in descendants.values():
+        node_descendants.sort(key=lambda node: get_preorder_key(node.get_matrix()))
+    return descendants
+
+def prefetch_descendants(queryset, nodes, max_depth=None):
+    for node, descendants in descendants_of_many(queryset, nodes, max_depth).iteritems():
+        set_prefetched(node, ('descendants', max_depth), descendants)
+
+def descendants_tree_of(node, max_depth=None, queryset=None):
+    """
+    Returns node as a TreeNode with its descendants attached. The whole
+    subtree is fetched with one query, also when max_depth limits the
+    number of levels below node and the model has a depth field. Without
+    it, one query per level is made.
+    """
+    if queryset is None:
+        queryset = type(node).objects
+    name11, name12, name21, name22, parent_name = node._nested_intervals_field_names
+
+    if max_depth is None or node._nested_intervals_depth_field_name:
+        descendants = tuple(descendants_of(node, max_depth, queryset))
+    else:
+        descendants = []
+        level = (node,)
+        for depth in xrange(max_depth):
+            keys = tuple(
+                (getattr(n, name11), getattr(n, name21))
+                for n in level)
+            level = tuple(
+                child
+                for chunk in chunked(keys)
+                for child in matrix_keys_filter(queryset, name12, name22, chunk))
+            if not level:
+                break
+            descendants.extend(level)
+
+    root, = build_tree((node,) + tuple(descendants))
+    return root
+
+PREORDER_CHUNK_SIZE = 1000
+
+def preorder(queryset):
+    """
+    queryset ordered depth first, by the left bound of the interval
+    ascending and the right bound descending, with the bounds available as
+    attributes. Returns the ordered queryset and the names of the bounds.
+
+    The order is approximate: the bounds are doubles, and once intervals
+    are narrower than double precision (e.g. about 20 levels of second
+    children) neighbouring nodes tie and fall back to pk order. Use
+    build_tree, or sort by get_preorder_key, for the exact order.
+    """
+    interval_field_names = queryset.model._nested_intervals_interval_field_names
+    if interval_field_names:
+        left_name, right_name = interval_field_names
+    else:
+        name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+        left_name, right_name = 'preorder_left', 'preorder_right'
+        left, right = interval_expressions(F(name11), F(name12), F(name21), F(name22))
+        queryset = queryset.annotate(**{left_name: left, right_name: right})
+    return queryset.order_by(left_name, '-'+right_name, 'pk'), (left_name, right_name)
+
+def iter_preorder(queryset, chunk_size=PREORDER_CHUNK_SIZE):
+    """
+    Yields every row of queryset depth first, fetching chunk_size rows
+    per query. Each query seeks past the (left, right, pk) of the last
+    row instead of using OFFSET, so every chunk costs the same and only
+    one chunk is held in memory.
+
+    The order is approximate, see preorder: nodes whose bounds are closer
+    than double precision may come out of depth first order, but every
+    row is still yielded exactly once.
+    """
+    queryset, (left_name, right_name) = preorder(queryset)
+    chunk_queryset = queryset
+    while True:
+        chunk = list(chunk_queryset[:chunk_size])
+        for node in chunk:
+            yield node
+        if len(chunk) < chunk_size:
+            return
+
+        last = chunk[-1]
+        left, right = getattr(last, left_name), getattr(last, right_name)
+        chunk_queryset = queryset.filter(
+            Q(**{left_name+'__gt': left})
+            | Q(**{left_name: left, right_name+'__lt': right})
+            | Q(**{left_name: left, right_name: right, 'pk__gt': last.pk}))
+
+def iter_descendants(node, chunk_size=PREORDER_CHUNK_SIZE, queryset=None):
+    """
+    The descendants of node depth first, see iter_preorder.
+    """
+    if queryset is None:
+        queryset = type(node).objects
+    return iter_preorder(descendants_of_matrix(queryset, node.get_matrix()), chunk_size)
+
 def last_child_of_matrix(queryset, parent_matrix):
     name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
     v11, v12, v21, v22 = (abs(v) for v in parent_matrix)
@@ -107,7 +820,7 @@ def last_child_of_matrix(queryset, parent_matrix):
         return queryset.filter(**{
             name12: v11,
             name22: v21
-        }).order_by((F(name11) / F(name12)).desc())[0]
+        }).order_by('-'+name11)[0]
     except IndexError:
         raise NoChildrenError()
 
@@ -115,39 +828,310 @@ def last_child_of(parent):
     validate_node(parent)
     name11, name12, name21, name22, parent_name = parent._nested_intervals_field_names
     try:
-        return children_of(parent).order_by((F(name11) / F(name12)).desc())[0]
+        return children_of(parent).order_by('-'+name11)[0]
     except IndexError:
         raise NoChildrenError()
 
 def last_child_nth_of(queryset, parent_matrix):
-    try:
-        last_child = last_child_of_matrix(queryset, parent_matrix)
-        return get_nth(last_child)
-    except NoChildrenError:
+    """
+    Siblings' a11 grows with their nth, so the last child is found by
+    seeking the (a12, a22, a11) index instead of sorting every child.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    v11, v12, v21, v22 = (abs(v) for v in parent_matrix)
+
+    last_child_a11 = children_of_matrix(queryset, (v11, v12, v21, v22)).order_by(
+        '-'+name11).values_list(name11, flat=True)[:1]
+    if not last_child_a11:
         return 0
+    return get_nth_from_a11(last_child_a11[0], v11)
+
+def allocate_child_nths(queryset, parent_matrix, count):
+    """
+    The next count free nths after the last child of parent_matrix.
+    """
+    first_nth = last_child_nth_of(queryset, parent_matrix) + 1
+    return xrange(first_nth, first_nth + count)
+
+def last_child_nths_of(queryset, parent_matrices):
+    """
+    Same as last_child_nth_of, but for many parent matrices at once.
+    Returns a dict of abs (parent a11, parent a21) to the last child nth,
+    which is 0 for parents without children.
+    """
+    name11, name12, name21, name22, parent_name = queryset.model._nested_intervals_field_names
+    keys = set((abs(m.a11), abs(m.a21)) for m in parent_matrices)
+    nths = dict.fromkeys(keys, 0)
+
+    for chunk in chunked(keys):
+        # The IN lists select a superset of the wanted groups,
+        # the unwanted groups are simply ignored below.
+        rows = queryset.filter(**{
+            name12+'__in': set(v11 for v11, v21 in chunk),
+            name22+'__in': set(v21 for v11, v21 in chunk),
+        }).order_by().values_list(name12, name22).annotate(
+            last_child_a11=Max(name11))
+
+        for v11, v21, last_child_a11 in rows:
+            if (v11, v21) in nths:
+                nths[(v11, v21)] = get_nth_from_a11(last_child_a11, v11)
+    return nths
+
+def bulk_update_values(queryset, field_names, rows, batch_size=None):
+    """
+    rows is an iterable of (pk, values) where values are in the same order
+    as field_names. Each batch is written with one UPDATE ... SET field =
+    CASE WHEN pk = .. THEN .. END statement, and only one batch of rows is
+    held in memory at a time.
+    """
+    fields = [queryset.model._meta.get_field(name) for name in field_names]
+    if batch_size is None:
+        # Every field takes two parameters per row, plus one for pk IN (...)
+        batch_size = max(connections[queryset.db].ops.bulk_batch_size(
+            ['pk'] + fields * 2, ()), 1)
+
+    updated = 0
+    with transaction.atomic(using=queryset.db):
+        for batch in chunked(rows, batch_size):
+            updated += queryset.filter(pk__in=[pk for pk, values in batch]).update(**{
+                field.name: Case(*[
+                    When(pk=pk, then=Value(values[i], output_field=field))
+                    for pk, values in batch
+                ], output_field=field)
+                for i, field in enumerate(fields)
+            })
+    return updated
+
+def bulk_update(queryset, instances, field_names, batch_size=None):
+    fields = [queryset.model._meta.get_field(name) for name in field_names]
+    return bulk_update_values(queryset, field_names, (
+        (instance.pk, tuple(getattr(instance, field.attname) for field in fields))
+        for instance in instances
+    ), batch_size)
 
 def reroot(node, parent, child_matrix):
+    """
+    Returns node followed by all of its descendants, each exactly once,
+    with node's matrix set to child_matrix and the descendants' matrices
+    following it. The whole subtree is fetched with a single query and the
+    hierarchy is rebuilt from the matrices in memory, so there is no limit
+    on the depth of the subtree.
+    """
     validate_node(node)
-    validate_node(parent)
-    parent_matrix = parent.get_matrix()
-    children = node.get_children()
+    if parent:
+        validate_node(parent)
+
+    old_matrix = node.get_matrix()
+    if parent and (
+            parent.get_matrix() == old_matrix or is_descendant_of_matrix(parent.get_matrix(), old_matrix)):
+        raise InvalidNodeError("'{}({})' cannot become a descendant of itself.".format(type(node).__name__, node.pk))
+
+    transform = child_matrix * get_inverse_matrix(old_matrix)
+    descendants = tuple(descendants_of_matrix(type(node).objects, old_matrix))
+    max_value = get_max_value(type(node))
 
+    nodes_by_key = {}
+    for n in (node,) + descendants:
+        v11, v12, v21, v22 = get_abs_matrix(n)
+        nodes_by_key[(v11, v21)] = n
+
+    parents = []
+    for descendant in descendants:
+        v11, v12, v21, v22 = get_abs_matrix(descendant)
+        parents.append(nodes_by_key.get((v12, v22)))
+
+    # Fail before any node is changed
+    new_matrices = tuple(
+        check_matrix(transform * get_matrix(descendant), max_value)
+        for descendant in descendants)
+
+    invalidate_cache(type(node))
     node.set_matrix(child_matrix)
     node.set_parent(parent)
 
-    descendants = functools.reduce(
-        operator.add,
-        (
-            reroot(
-                child,
-                node,
-                get_child_matrix(child_matrix, i+1))
-            for i, child in enumerate(children)
-        ),
-        (),
-    )
-    return (node,) + tuple(children) + descendants
+    for descendant, descendant_parent, new_matrix in zip(descendants, parents, new_matrices):
+        set_matrix(descendant, new_matrix)
+        if descendant_parent is not None:
+            set_parent(descendant, descendant_parent)
+
+    return (node,) + descendants
+
+def subtree_subquery(queryset, aggregate_sql, include_self):
+    """
+    SQL of a subquery that aggregates aggregate_sql, which refers to the
+    rows of the subtree as 'subtree', over the descendants of each row of
+    queryset, or over its subtree with include_self.
+    """
+    Model = queryset.model
+    quote_name = connections[queryset.db].ops.quote_name
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    interval_field_names = Model._nested_intervals_interval_field_names
+
+    def outer(name):
+        return '{}.{}'.format(quote_name(Model._meta.db_table), quote_name(Model._meta.get_field(name).column))
+
+    def inner(name):
+        return 'subtree.{}'.format(quote_name(Model._meta.get_field(name).column))
+
+    def bigint(name, sql):
+        return bigint_sql(connections[queryset.db], Model, name, sql)
+
+    conditions = [
+        '{} {} {}'.format(inner(name21), '>=' if include_self else '>', outer(name21)),
+        '{} >= {}'.format(inner(name11), outer(name11)),
+        '{} * ({} - {}) > ({} - {}) * {}'.format(
+            bigint(name11, inner(name11)), outer(name21), outer(name22),
+            bigint(name11, outer(name11)), outer(name12), inner(name21)),
+        '{} * {} {} {} * {}'.format(
+            bigint(name11, inner(name11)), outer(name21), '<=' if include_self else '<',
+            bigint(name11, outer(name11)), inner(name21)),
+    ]
+    if interval_field_names:
+        left_name, right_name = interval_field_names
+        conditions[0:0] = [
+            '{} > {} - {!r}'.format(inner(right_name), outer(left_name), INTERVAL_EPSILON),
+            '{} < {} + {!r}'.format(inner(right_name), outer(right_name), INTERVAL_EPSILON),
+        ]
+
+    return '(SELECT {} FROM {} subtree WHERE {})'.format(
+        aggregate_sql,
+        quote_name(Model._meta.db_table),
+        ' AND '.join(conditions))
+
+def annotate_descendant_count(queryset, name='descendant_count'):
+    """
+    Annotate every row with the number of its descendants, counted by a
+    correlated subquery on the interval containment predicate.
+    """
+    return queryset.extra(select={name: subtree_subquery(queryset, 'COUNT(*)', False)})
+
+def annotate_subtree(queryset, *aggregates, **named_aggregates):
+    """
+    Annotate every row with aggregates over its subtree, the row itself
+    included, e.g. annotate_subtree(queryset, total=Sum('stock')).
+    Aggregates are Django aggregates of a single field.
+    """
+    quote_name = connections[queryset.db].ops.quote_name
+    named_aggregates.update((aggregate.default_alias, aggregate) for aggregate in aggregates)
+
+    select = {}
+    for name, aggregate in named_aggregates.iteritems():
+        expression, = aggregate.get_source_expressions()
+        column = queryset.model._meta.get_field(expression.name).column
+        select[name] = subtree_subquery(
+            queryset,
+            '{}(subtree.{})'.format(aggregate.function, quote_name(column)),
+            True)
+    return queryset.extra(select=select)
+
+def rollup_subtrees(queryset, field_name=None):
+    """
+    The same numbers as the annotations, computed in Python over one fetch
+    of queryset, for backends where the subquery is slow. Nodes are linked
+    to their parents by the exact keys of build_tree, not the float
+    intervals. Returns (descendant count, sum of field_name over the
+    subtree) keyed by pk, where queryset holds whole subtrees.
+    """
+    totals = {}
+    stack = [(root, False) for root in build_tree(queryset)]
+    while stack:
+        tree_node, visited = stack.pop()
+        if not visited:
+            stack.append((tree_node, True))
+            stack.extend((child, False) for child in tree_node.children)
+            continue
+        count = 0
+        total = (getattr(tree_node.node, field_name) or 0) if field_name else 0
+        for child in tree_node.children:
+            child_count, child_total = totals[child.node.pk]
+            count += child_count + 1
+            total += child_total
+        totals[tree_node.node.pk] = (count, total)
+    return totals
 
 class NestedIntervalsQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super(NestedIntervalsQuerySet, self).__init__(*args, **kwargs)
+        self._nested_intervals_prefetch = ()
+
+    def _clone(self, *args, **kwargs):
+        clone = super(NestedIntervalsQuerySet, self)._clone(*args, **kwargs)
+        clone._nested_intervals_prefetch = self._nested_intervals_prefetch
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super(NestedIntervalsQuerySet, self)._fetch_all()
+        if fetched or not self._nested_intervals_prefetch:
+            return
+
+        nodes = [node for node in self._result_cache if isinstance(node, self.model)]
+        for prefetch, args in self._nested_intervals_prefetch:
+            prefetch(self.model.objects, nodes, *args)
+
+    def prefetch_ancestors(self):
+        """
+        Fetch the ancestors of every node of this queryset, once it is
+        evaluated, so that get_ancestors() makes no query.
+        """
+        clone = self._clone()
+        clone._nested_intervals_prefetch += ((prefetch_ancestors, ()),)
+        return clone
+
+    def prefetch_descendants(self, max_depth=None):
+        """
+        Fetch the descendants of every node of this queryset, once it is
+        evaluated, so that get_descendants(max_depth) makes no query, and
+        neither does get_children() for max_depth=1.
+        """
+        clone = self._clone()
+        clone._nested_intervals_prefetch += ((prefetch_descendants, (max_depth,)),)
+        return clone
+
     def children_of(self, parent):
-        return children_of(self, parent)
+        return children_of(parent, self)
+
+    def children_of_many(self, nodes):
+        return children_of_many(self, nodes)
+
+    def parents_of_many(self, nodes):
+        return parents_of_many(self, nodes)
+
+    def ancestors_of_many(self, nodes):
+        return ancestors_of_many(self, nodes)
+
+    def as_tree(self):
+        """
+        The nodes of this queryset as TreeNodes, linked to their parents
+        within the queryset. Iterate a TreeNode for (depth, node) pairs.
+        """
+        return build_tree(self)
+
+    def at_depth(self, depth):
+        return at_depth(self, depth)
+
+    def descendants_of(self, node, max_depth=None):
+        return descendants_of(node, max_depth, self)
+
+    def subtree_of(self, node):
+        return subtree_of(node, self)
+
+    def family_line_of(self, node):
+        return family_line_of(node, self)
+
+    def siblings_of(self, node, include_self=False):
+        return siblings_of(node, include_self, self)
+
+    def annotate_descendant_count(self, name='descendant_count'):
+        return annotate_descendant_count(self, name)
+
+    def annotate_subtree(self, *aggregates, **named_aggregates):
+        return annotate_subtree(self, *aggregates, **named_aggregates)
+
+    def tree_order(self):
+        """
+        This queryset ordered depth first in SQL, see preorder. The order
+        is approximate once intervals are narrower than double precision.
+        """
+        queryset, interval_names = preorder(self)
+        return queryset
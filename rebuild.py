@@ -0,0 +1,180 @@
+"""
+Recompute the matrices of the nodes from their parent foreign key, which
+is taken to be correct, and rewrite only the rows whose stored values
+disagree with it.
+"""
+from collections import defaultdict
+from collections import namedtuple
+from itertools import chain
+
+from django.db import transaction
+
+from nested_intervals.cache import invalidate_cache
+from nested_intervals.capacity import get_max_value
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.queryset import INTERVAL_EPSILON
+from nested_intervals.queryset import bulk_update_values
+from nested_intervals.queryset import get_matrix_field_names
+from nested_intervals.queryset import get_matrix_field_values
+from nested_intervals.utils import chunked
+
+RebuildReport = namedtuple('RebuildReport', (
+    'checked',
+    'updated',
+    'unreachable',
+))
+
+def get_stored_nth(values):
+    v11, v12 = values[0:2]
+    if v11 is None or not v12:
+        return None
+    nth = int(v11 // v12)
+    return nth if nth >= 1 else None
+
+def assign_nths(parent_matrix, rows):
+    """
+    rows are (pk, stored values) of the children of parent_matrix. Returns
+    (nth, pk, stored values) for every row.
+
+    A row keeps the nth of its stored matrix unless another sibling
+    already has it, where rows that are stored as children of
+    parent_matrix come first. The other rows follow the largest kept nth
+    in pk order.
+    """
+    parent_key = (abs(parent_matrix.a11), abs(parent_matrix.a21))
+
+    def priority(row):
+        pk, values = row
+        v11, v12, v21, v22 = values[0:4]
+        return ((v12, v22) != parent_key, pk)
+
+    kept = []
+    rest = []
+    taken = set()
+    for pk, values in sorted(rows, key=priority):
+        nth = get_stored_nth(values)
+        if nth is None or nth in taken:
+            rest.append((pk, values))
+        else:
+            taken.add(nth)
+            kept.append((nth, pk, values))
+
+    last_nth = max(taken) if taken else 0
+    return kept + [
+        (nth, pk, values)
+        for nth, (pk, values) in enumerate(sorted(rest), last_nth + 1)
+    ]
+
+def is_stale(Model, values, matrix):
+    """
+    Whether the stored values differ from the fields of matrix. Interval
+    fields computed by the database may differ by rounding.
+    """
+    interval_field_names = Model._nested_intervals_interval_field_names or ()
+    correct_values = get_matrix_field_values(Model, matrix)
+    for name, value in zip(get_matrix_field_names(Model), values):
+        correct_value = correct_values[name]
+        if value is None:
+            return True
+        if name in interval_field_names:
+            if abs(value - correct_value) > INTERVAL_EPSILON:
+                return True
+        elif value != correct_value:
+            return True
+    return False
+
+def children_by_parent_id(queryset, parent_ids):
+    parent_name = queryset.model._nested_intervals_field_names[-1]
+    children = defaultdict(list)
+    for chunk in chunked(parent_ids):
+        for row in queryset.filter(**{parent_name+'__in': chunk}).values_list(
+                'pk', parent_name+'_id', *get_matrix_field_names(queryset.model)):
+            children[row[1]].append((row[0], row[2:]))
+    return children
+
+def iter_subtree(queryset, root_pk, root_matrix, max_value):
+    """
+    Yields (pk, stored values, correct matrix) of every descendant of the
+    root, one level at a time.
+    """
+    matrices = {root_pk: root_matrix}
+    while matrices:
+        children = children_by_parent_id(queryset, list(matrices))
+        next_matrices = {}
+        for parent_id, rows in children.iteritems():
+            for nth, pk, values in assign_nths(matrices[parent_id], rows):
+                matrix = get_child_matrix(matrices[parent_id], nth, max_value)
+                next_matrices[pk] = matrix
+                yield pk, values, matrix
+        matrices = next_matrices
+
+def rebuild_tree(queryset, root_pk, root_values, root_matrix, batch_size=None):
+    """
+    Rewrite the stale rows of one tree in a transaction. Returns the
+    number of checked and the number of updated rows.
+
+    The stale rows are first moved to (a11, a21) pairs with a11 = 0, as in
+    load_tree, so that a rewritten row never takes the matrix that a row
+    not yet rewritten still holds under the unique (a11, a21) index.
+    """
+    Model = queryset.model
+    max_value = get_max_value(Model)
+    field_names = get_matrix_field_names(Model)
+
+    checked = 0
+    stale = []
+    with transaction.atomic(using=queryset.db):
+        for pk, values, matrix in chain(
+                ((root_pk, root_values, root_matrix),),
+                iter_subtree(queryset, root_pk, root_matrix, max_value)):
+            checked += 1
+            if is_stale(Model, values, matrix):
+                field_values = get_matrix_field_values(Model, matrix)
+                stale.append((pk, tuple(field_values[name] for name in field_names)))
+
+        if stale:
+            name11, name12, name21, name22 = field_names[0:4]
+            bulk_update_values(queryset, (name11, name21), (
+                (pk, (0, i)) for i, (pk, values) in enumerate(stale, 1)), batch_size)
+            bulk_update_values(queryset, field_names, stale, batch_size)
+            invalidate_cache(Model)
+    return checked, len(stale)
+
+def rebuild_nested_intervals(queryset, root_ids=None, batch_size=None, progress=None):
+    """
+    Rebuild the trees of the roots in queryset, or only those of root_ids,
+    one root per transaction, so that a large forest can be repaired a
+    part at a time. progress, if given, is called with the pk of each
+    rebuilt root and the number of rows it updated.
+
+    Nodes that no root reaches through parents, because of a cycle, are
+    counted as unreachable when every root is rebuilt.
+    """
+    Model = queryset.model
+    name11, name12, name21, name22, parent_name = Model._nested_intervals_field_names
+    max_value = get_max_value(Model)
+    if root_ids is not None:
+        root_ids = set(root_ids)
+
+    roots = queryset.filter(**{parent_name: None}).values_list(
+        'pk', *get_matrix_field_names(Model))
+
+    checked = 0
+    updated = 0
+    for nth, pk, values in assign_nths(INVISIBLE_ROOT_MATRIX, ((row[0], row[1:]) for row in roots)):
+        if root_ids is not None and pk not in root_ids:
+            continue
+        root_checked, root_updated = rebuild_tree(
+            queryset, pk, values,
+            get_child_matrix(INVISIBLE_ROOT_MATRIX, nth, max_value),
+            batch_size)
+        checked += root_checked
+        updated += root_updated
+        if progress is not None:
+            progress(pk, root_updated)
+
+    return RebuildReport(
+        checked=checked,
+        updated=updated,
+        unreachable=None if root_ids is not None else queryset.count() - checked)
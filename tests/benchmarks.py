@@ -0,0 +1,221 @@
+"""
+Benchmarks are not discovered by the default test run. Run them with:
+
+    django-admin test nested_intervals.tests.benchmarks --settings=nested_intervals.tests.settings
+"""
+from decimal import Decimal
+from pyrsistent import pvector
+import math
+import sys
+import time
+
+from django.db import OperationalError
+from django.db import transaction
+from django.db.models import Q
+from django.test import TestCase
+
+from nested_intervals.integrity import check_integrity
+from nested_intervals.models import bulk_create
+from nested_intervals.models import clean_nested_intervals_by_parent_id
+from nested_intervals.models import update
+from nested_intervals.queryset import rollup_subtrees
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import Matrix
+from nested_intervals.matrix import get_ancestors_matrix
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.tests.models import ExampleModel
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - start, result
+
+def report(name, **timings):
+    print('\n{}: {}'.format(name, ', '.join(
+        '{}={:.4f}s'.format(key, value)
+        for key, value in sorted(timings.items()))))
+
+def create_wide_tree(Model, depth, fanout, parent_id=None):
+    """
+    Returns the pks of every level, created with one bulk_create per level.
+    """
+    levels = []
+    parent_ids = (parent_id,)
+    for level in xrange(depth):
+        parent_ids = bulk_create(Model, ('name', 'parent_id'), [
+            {'name': str(level), 'parent_id': parent_id}
+            for parent_id in parent_ids
+            for i in xrange(fanout)
+        ])
+        levels.append(parent_ids)
+    return levels
+
+def create_chain(Model, depth):
+    parent_id = None
+    for level in xrange(depth):
+        parent_id, = bulk_create(Model, ('name', 'parent_id'), [
+            {'name': str(level), 'parent_id': parent_id}])
+    return Model.objects.get(pk=parent_id)
+
+def decimal_parent_matrix(matrix):
+    nth_child = int(math.floor(abs(Decimal(matrix.a11)) / abs(Decimal(matrix.a12))))
+    return Matrix(
+        matrix.a12 * (-1),
+        matrix.a11 + matrix.a12 * (nth_child+1),
+        matrix.a22 * (-1),
+        matrix.a21 + matrix.a22 * (nth_child+1))
+
+def recursive_ancestors_matrix(matrix, l=pvector()):
+    """
+    The recursion get_ancestors_matrix used to do.
+    """
+    parent_matrix = decimal_parent_matrix(matrix)
+    if parent_matrix == INVISIBLE_ROOT_MATRIX:
+        return l
+    return recursive_ancestors_matrix(parent_matrix, l.append(parent_matrix))
+
+def recursive_update(Model, pk, parent_id):
+    """
+    The recursion update() used to do: one UPDATE, one parent lookup and
+    one last child lookup per node of the moved subtree.
+    """
+    with transaction.atomic():
+        fields = clean_nested_intervals_by_parent_id(Model, parent_id)
+        Model.objects.filter(pk=pk).update(parent=parent_id, **fields)
+        for child_pk in Model.objects.filter(parent=pk).values_list('pk', flat=True):
+            recursive_update(Model, child_pk, pk)
+
+
+class MoveSubtreeBenchmark(TestCase):
+    def move(self, f):
+        root1, root2 = bulk_create(ExampleModel, ('name', 'parent_id'), [
+            {'name': 'root1', 'parent_id': None},
+            {'name': 'root2', 'parent_id': None},
+        ])
+        (subtree,), = create_wide_tree(ExampleModel, 1, 1, root1)
+        create_wide_tree(ExampleModel, 3, 10, subtree)
+
+        seconds, result = timed(f, subtree, root2)
+        matrices = tuple(
+            node.get_matrix()
+            for node in ExampleModel.objects.get(pk=root2).get_descendants().order_by('pk'))
+        ExampleModel.objects.all().delete()
+        return seconds, matrices
+
+    def test_move_subtree(self):
+        set_based, set_based_matrices = self.move(lambda pk, parent_id: update(
+            ExampleModel, ('parent_id',), {'id': pk}, {'parent_id': parent_id}))
+        recursive, recursive_matrices = self.move(lambda pk, parent_id: recursive_update(
+            ExampleModel, pk, parent_id))
+
+        self.assertEqual(len(set_based_matrices), 1111)
+        self.assertEqual(set_based_matrices, recursive_matrices)
+        report('Move 1111 node subtree', set_based=set_based, recursive=recursive)
+
+
+class AncestorsMatrixBenchmark(TestCase):
+    def setUp(self):
+        self.recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(5000)
+
+    def tearDown(self):
+        sys.setrecursionlimit(self.recursion_limit)
+
+    def test_ancestors_matrix(self):
+        for depth in (10, 100, 1000):
+            matrix = INVISIBLE_ROOT_MATRIX
+            for i in xrange(depth):
+                matrix = get_child_matrix(matrix, 3)
+
+            iterative, iterative_ancestors = timed(lambda: [get_ancestors_matrix(matrix) for i in xrange(100)])
+            recursive, recursive_ancestors = timed(lambda: [recursive_ancestors_matrix(matrix) for i in xrange(100)])
+
+            self.assertEqual(list(iterative_ancestors[0]), list(recursive_ancestors[0]))
+            report('100 ancestor walks at depth {}'.format(depth), iterative=iterative, recursive=recursive)
+
+
+class AncestorsBenchmark(TestCase):
+    def or_chain_ancestors(self, node):
+        """
+        The chain of OR'ed Q objects get_ancestors used to build.
+        """
+        return ExampleModel.objects.filter(reduce(
+            lambda a, b: a | Q(**ExampleModel.build_nested_intervals_query_kwargs(*b)),
+            get_ancestors_matrix(node.get_matrix()),
+            Q()))
+
+    def test_ancestors(self):
+        for depth in (100, 1000):
+            node = create_chain(ExampleModel, depth)
+
+            row_values, row_values_pks = timed(lambda: list(node.get_ancestors().values_list('pk', flat=True)))
+            self.assertEqual(len(row_values_pks), depth - 1)
+
+            try:
+                with transaction.atomic():
+                    or_chain, or_chain_pks = timed(lambda: list(self.or_chain_ancestors(node).values_list('pk', flat=True)))
+            except OperationalError as e:
+                # SQLite refuses expression trees deeper than 1000
+                print('\nOR chain at depth {} failed: {}'.format(depth, e))
+                report('Ancestors at depth {}'.format(depth), row_values=row_values)
+            else:
+                self.assertEqual(sorted(row_values_pks), sorted(or_chain_pks))
+                report('Ancestors at depth {}'.format(depth), row_values=row_values, or_chain=or_chain)
+
+            ExampleModel.objects.all().delete()
+
+
+class IntegrityBenchmark(TestCase):
+    def test_check_integrity(self):
+        create_wide_tree(ExampleModel, 5, 10)
+
+        seconds, result = timed(check_integrity, ExampleModel.objects)
+
+        self.assertEqual(result.checked, 111110)
+        self.assertTrue(result.is_valid)
+        report('Check integrity of 111110 rows', check_integrity=seconds)
+
+
+class FamilyLineBenchmark(TestCase):
+    def or_family_line(self, node):
+        """
+        The union of three querysets get_family_line used to build.
+        """
+        return node.get_ancestors() | node.get_descendants() | ExampleModel.objects.filter(pk=node.pk)
+
+    def test_family_line(self):
+        levels = create_wide_tree(ExampleModel, 5, 10)
+        nodes = list(ExampleModel.objects.filter(pk__in=[level[len(level) // 2] for level in levels]))
+
+        for node in nodes:
+            single, single_pks = timed(lambda: [
+                list(node.get_family_line().values_list('pk', flat=True)) for i in xrange(10)])
+            union, union_pks = timed(lambda: [
+                list(self.or_family_line(node).values_list('pk', flat=True)) for i in xrange(10)])
+            subtree, subtree_pks = timed(lambda: [
+                list(node.get_subtree().values_list('pk', flat=True)) for i in xrange(10)])
+
+            self.assertEqual(sorted(single_pks[0]), sorted(union_pks[0]))
+            self.assertEqual(
+                sorted(subtree_pks[0]),
+                sorted(list(node.get_descendants().values_list('pk', flat=True)) + [node.pk]))
+            report(
+                '10 family lines of 111110 rows at depth {}'.format(node.get_depth()),
+                single=single, union=union, subtree=subtree)
+
+
+class SubtreeAggregateBenchmark(TestCase):
+    def test_descendant_count(self):
+        create_wide_tree(ExampleModel, 4, 10)
+
+        subquery, subquery_counts = timed(lambda: dict(
+            ExampleModel.objects.annotate_descendant_count().values_list('pk', 'descendant_count')))
+        rollup, rollup_counts = timed(lambda: dict(
+            (pk, count) for pk, (count, total) in rollup_subtrees(ExampleModel.objects.all()).items()))
+        per_node, per_node_counts = timed(lambda: dict(
+            (node.pk, node.get_descendants().count()) for node in ExampleModel.objects.all()))
+
+        self.assertEqual(subquery_counts, per_node_counts)
+        self.assertEqual(rollup_counts, per_node_counts)
+        report('Descendant counts of 11110 nodes', subquery=subquery, rollup=rollup, per_node=per_node)
@@ -2,12 +2,16 @@ from django.db import models
 
 import nested_intervals
 from nested_intervals import register_fields
+from nested_intervals.cache import LRUCache
+from nested_intervals.managers import NestedIntervalsManager
 from nested_intervals.models import NestedIntervalsModelMixin
 
 
 class ExampleModel(NestedIntervalsModelMixin, models.Model):
     name = models.CharField(max_length=10)
 
+    objects = NestedIntervalsManager()
+
     def __unicode__(self):
         return u'{} {} {} {}'.format(
             self.lnumerator,
@@ -15,7 +19,20 @@ class ExampleModel(NestedIntervalsModelMixin, models.Model):
             self.ldenominator,
             self.rdenominator)
 
-nested_intervals.register_fields(ExampleModel, 'lnumerator','rnumerator', 'ldenominator', 'rdenominator', 'parent')
+nested_intervals.register_fields(ExampleModel, 'lnumerator','rnumerator', 'ldenominator', 'rdenominator', 'parent',
+    indexes=True,
+    interval_fields=('lbound', 'rbound'),
+    depth_field='depth')
+
+
+class CachedExampleModel(NestedIntervalsModelMixin, models.Model):
+    name = models.CharField(max_length=10)
+
+    objects = NestedIntervalsManager()
+
+nested_intervals.register_fields(CachedExampleModel, 'lnumerator','rnumerator', 'ldenominator', 'rdenominator', 'parent',
+    indexes=True,
+    cache=LRUCache(100))
 
 
 class ExampleModelWithoutNestedIntervals(models.Model):
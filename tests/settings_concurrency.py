@@ -0,0 +1,14 @@
+"""
+Settings for test_concurrency, whose threads only share an SQLite test
+database on disk, e.g.
+
+    DJANGO_SETTINGS_MODULE=nested_intervals.tests.settings_concurrency \
+        django-admin test nested_intervals.tests.test_concurrency
+"""
+import os
+
+from nested_intervals.tests.settings import *
+
+DATABASES['default']['TEST'] = {
+    'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+}
@@ -0,0 +1,77 @@
+from django.test import TestCase
+
+from nested_intervals import batch
+from nested_intervals.matrix import compose_path
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.matrix import get_parent_matrix
+from nested_intervals.matrix import is_descendant_of_matrix
+from nested_intervals.tests.test_model import create_test_tree
+from nested_intervals.tests.models import ExampleModel
+
+
+def abs_columns(matrices):
+    return tuple(
+        [abs(matrix[i]) for matrix in matrices]
+        for i in xrange(4))
+
+def as_lists(columns):
+    return tuple([int(num) for num in column] for column in columns)
+
+
+class BatchTest(TestCase):
+    matrices = (
+        compose_path((1,)),
+        compose_path((3, 2)),
+        compose_path((2, 1, 4)),
+        compose_path((1, 1, 1, 7)),
+    )
+
+    def assert_batch(self):
+        columns = abs_columns(self.matrices)
+
+        self.assertEqual(
+            [int(num) for num in batch.nths(columns[0], columns[1])],
+            [1, 2, 4, 7])
+        self.assertEqual(
+            as_lists(batch.parent_matrices(*columns)),
+            abs_columns([get_parent_matrix(m) for m in self.matrices]))
+        self.assertEqual(
+            as_lists(batch.child_matrices(*(columns + ([1, 2, 3, 4],)))),
+            abs_columns([get_child_matrix(m, i+1) for i, m in enumerate(self.matrices)]))
+        self.assertEqual(
+            [bool(b) for b in batch.descendant_mask(*(columns + (compose_path((1,)),)))],
+            [is_descendant_of_matrix(m, compose_path((1,))) for m in self.matrices])
+
+    def test_batch(self):
+        self.assert_batch()
+
+    def test_batch_overflow(self):
+        # Entries too large for int64 fall back to Python ints
+        deep = compose_path((3,) * 60)
+        self.assertGreater(abs(deep.a21), batch.INT64_MAX)
+        self.matrices = self.matrices + (deep,)
+
+        columns = abs_columns(self.matrices)
+        self.assertEqual(
+            as_lists(batch.parent_matrices(*columns)),
+            abs_columns([get_parent_matrix(m) for m in self.matrices]))
+        self.assertEqual(
+            as_lists(batch.child_matrices(*(columns + ([2] * 5,)))),
+            abs_columns([get_child_matrix(m, 2) for m in self.matrices]))
+
+    def test_batch_without_numpy(self):
+        numpy = batch.numpy
+        batch.numpy = None
+        try:
+            self.assert_batch()
+        finally:
+            batch.numpy = numpy
+
+    def test_matrix_columns(self):
+        tree = create_test_tree()
+        pks, a11, a12, a21, a22 = batch.matrix_columns(ExampleModel.objects.order_by('pk'))
+
+        self.assertEqual(list(pks), [node.pk for node in ExampleModel.objects.order_by('pk')])
+        self.assertEqual(
+            list(batch.descendant_mask(a11, a12, a21, a22, tree['2'].get_matrix())),
+            [pk in (tree['2.1'].pk, tree['2.1.1'].pk, tree['2.2'].pk) for pk in pks])
@@ -0,0 +1,109 @@
+from django.test import TestCase
+
+from nested_intervals.cache import LRUCache
+from nested_intervals.cache import DjangoCache
+from nested_intervals.cache import LRUCacheMiddleware
+from nested_intervals.models import update
+from nested_intervals.queryset import ancestors_of_matrix
+from nested_intervals.queryset import save_as_child_of
+from nested_intervals.tests.models import CachedExampleModel
+from nested_intervals.tests.test_model import create_test_tree
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+        cache.clear()
+        self.assertEqual(cache.get('c'), None)
+
+    def test_django_cache(self):
+        cache = DjangoCache(prefix='test_nested_intervals')
+        cache.set((1, 2), 'node')
+        self.assertEqual(cache.get((1, 2)), 'node')
+
+        cache.clear()
+        self.assertEqual(cache.get((1, 2)), None)
+
+    def test_django_cache_many(self):
+        cache = DjangoCache(prefix='test_nested_intervals')
+        cache.set_many({(1, 2): 'a', (3, 7): 'b'})
+        self.assertEqual(cache.get_many([(1, 2), (3, 7), (5, 3)]), {(1, 2): 'a', (3, 7): 'b'})
+
+        cache.clear()
+        self.assertEqual(cache.get_many([(1, 2), (3, 7)]), {})
+
+    def test_middleware(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        LRUCacheMiddleware().process_request(None)
+        self.assertEqual(cache.get('a'), None)
+
+        cache.set('a', 1)
+        response = object()
+        self.assertIs(LRUCacheMiddleware().process_response(None, response), response)
+        self.assertEqual(cache.get_many(['a']), {})
+
+
+class CachedModelTest(TestCase):
+    def setUp(self):
+        CachedExampleModel._nested_intervals_cache.clear()
+        self.tree = create_test_tree(CachedExampleModel, CachedExampleModel.objects.get)
+
+    def test_parent_and_root(self):
+        node, parent, root = (self.tree[i] for i in ('2.1.1', '2.1', '0'))
+        self.assertEqual(node.get_parent(), parent)
+        self.assertEqual(node.get_root(), root)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(node.get_parent(), parent)
+            self.assertEqual(node.get_root(), root)
+
+    def test_ancestors(self):
+        node = self.tree['2.1.1']
+        ancestors = [self.tree[i] for i in ('2.1', '2', '0')]
+        self.assertEqual(list(node.get_ancestors()), ancestors)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(node.get_ancestors()), ancestors)
+            self.assertEqual(node.get_parent(), ancestors[0])
+
+        # The same order as without the cache
+        CachedExampleModel._nested_intervals_cache.clear()
+        self.assertEqual(list(node.get_ancestors()), ancestors)
+        self.assertEqual(list(ancestors_of_matrix(CachedExampleModel.objects, node.get_matrix())), ancestors)
+
+    def test_invalidate_on_save(self):
+        node = self.tree['2.1']
+        self.assertEqual(node.get_parent().name, '2')
+
+        parent = self.tree['2']
+        parent.name = 'Two'
+        parent.save()
+        self.assertEqual(node.get_parent().name, 'Two')
+
+    def test_invalidate_on_move(self):
+        node = self.tree['2.1.1']
+        self.assertEqual(node.get_parent(), self.tree['2.1'])
+        self.assertEqual(node.get_root(), self.tree['0'])
+
+        update(CachedExampleModel, ('parent_id',), {'id': self.tree['2'].pk}, {'parent_id': None})
+        node = self.tree['2.1.1']
+        self.assertEqual(node.get_parent(), self.tree['2.1'])
+        self.assertEqual(node.get_root(), self.tree['2'])
+        self.assertEqual(list(node.get_ancestors()), [self.tree['2.1'], self.tree['2']])
+
+        save_as_child_of(self.tree['2'], self.tree['1'])
+        node = self.tree['2.1.1']
+        self.assertEqual(node.get_root(), self.tree['0'])
+        self.assertEqual(list(node.get_ancestors()), [self.tree[i] for i in ('2.1', '2', '1', '0')])
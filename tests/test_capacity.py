@@ -0,0 +1,110 @@
+from django.db import models
+from django.test import TestCase
+
+from nested_intervals import build_nested_intervals_field
+from nested_intervals.capacity import capacity_report
+from nested_intervals.capacity import get_safe_max_value
+from nested_intervals.capacity import get_storage_max_value
+from nested_intervals.capacity import max_safe_depth
+from nested_intervals.capacity import max_safe_fanout
+from nested_intervals.capacity import widest_matrix
+from nested_intervals.exceptions import MatrixOverflowError
+from nested_intervals.matrix import compose_path
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.queryset import bigint_expression
+from nested_intervals.queryset import bigint_sql
+from nested_intervals.queryset import save_as_child_of
+from nested_intervals.queryset import save_as_root
+from nested_intervals.tests.models import ExampleModel
+from nested_intervals.tests.test_model import create_test_tree
+
+
+class CapacityTest(TestCase):
+    def test_storage(self):
+        self.assertIsInstance(build_nested_intervals_field('integer'), models.PositiveIntegerField)
+        self.assertIsInstance(build_nested_intervals_field('bigint'), models.BigIntegerField)
+        self.assertIsInstance(build_nested_intervals_field('decimal', 50), models.DecimalField)
+        self.assertEqual(get_storage_max_value('decimal', 50), 10 ** 50 - 1)
+        self.assertEqual(ExampleModel._nested_intervals_max_value, 2 ** 31 - 1)
+
+        with self.assertRaises(ValueError):
+            build_nested_intervals_field('float')
+
+    def test_safe_max_value(self):
+        # Integer products are computed in 64 bits, bigint products would overflow
+        self.assertEqual(get_safe_max_value('integer'), 2 ** 31 - 1)
+        self.assertEqual(get_safe_max_value('bigint'), 3037000499)
+        self.assertEqual(get_safe_max_value('decimal', 50), 10 ** 50 - 1)
+        self.assertEqual(ExampleModel._nested_intervals_storage_max_value, 2 ** 31 - 1)
+
+    def test_bigint_products(self):
+        class Connection(object):
+            def __init__(self, vendor):
+                self.vendor = vendor
+
+        self.assertEqual(
+            bigint_sql(Connection('postgresql'), ExampleModel, 'lnumerator'),
+            'CAST(lnumerator AS BIGINT)')
+        self.assertEqual(bigint_sql(Connection('sqlite'), ExampleModel, 'lnumerator'), 'lnumerator')
+        self.assertEqual(bigint_sql(Connection('postgresql'), ExampleModel, 'name', 'x'), 'x')
+
+        product = bigint_expression(Connection('postgresql'), ExampleModel, 'lnumerator') * 3
+        self.assertIn(
+            'CAST("tests_examplemodel"."lnumerator" AS BIGINT) * 3',
+            str(ExampleModel.objects.annotate(product=product).query))
+
+    def test_max_safe_depth(self):
+        max_value = get_safe_max_value('integer')
+        self.assertEqual(max_safe_depth(max_value), max_value - 1)
+
+        for fanout in (2, 10, 1000):
+            depth = max_safe_depth(max_value, fanout)
+            self.assertLessEqual(max(widest_matrix(depth, fanout)), max_value)
+            self.assertGreater(max(widest_matrix(depth + 1, fanout)), max_value)
+
+        # The products of the predicates overflow 64 bits deeper than this
+        self.assertEqual(max_safe_depth(get_safe_max_value('bigint'), 2), 22)
+
+    def test_max_safe_fanout(self):
+        max_value = get_safe_max_value('bigint')
+        for depth in (1, 5, 20):
+            fanout = max_safe_fanout(max_value, depth)
+            self.assertLessEqual(max(widest_matrix(depth, fanout)), max_value)
+            self.assertGreater(max(widest_matrix(depth, fanout + 1)), max_value)
+        self.assertEqual(max_safe_fanout(10, 100), 0)
+
+    def test_reject_overflow(self):
+        with self.assertRaises(MatrixOverflowError):
+            get_child_matrix(compose_path((2 ** 30,)), 2, 2 ** 31 - 1)
+
+        root = ExampleModel(name='root')
+        save_as_root(root)
+        root.set_matrix(compose_path((2 ** 29,)))
+        root.save()
+
+        save_as_child_of(ExampleModel(name='1'), root)
+        save_as_child_of(ExampleModel(name='2'), root)
+        with self.assertRaises(MatrixOverflowError):
+            save_as_child_of(ExampleModel(name='3'), root)
+        self.assertEqual(ExampleModel.objects.count(), 3)
+
+    def test_capacity_report(self):
+        create_test_tree()
+        report = capacity_report(ExampleModel.objects)
+
+        self.assertEqual(report.max_value, 2 ** 31 - 1)
+        self.assertEqual(report.safe_max_value, 2 ** 31 - 1)
+        self.assertEqual(report.largest_value, 13)
+        self.assertEqual(report.largest_nth, 3)
+        self.assertEqual(report.max_safe_depth, max_safe_depth(2 ** 31 - 1, 3))
+        self.assertAlmostEqual(report.usage, 13.0 / (2 ** 31 - 1))
+
+        # Usage is relative to the limit of the queries, not of the column
+        ExampleModel._nested_intervals_max_value = 46340
+        try:
+            report = capacity_report(ExampleModel.objects)
+        finally:
+            ExampleModel._nested_intervals_max_value = 2 ** 31 - 1
+        self.assertEqual(report.max_value, 2 ** 31 - 1)
+        self.assertAlmostEqual(report.usage, 13.0 / 46340)
+        self.assertEqual(report.max_safe_depth, max_safe_depth(46340, 3))
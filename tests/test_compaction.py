@@ -0,0 +1,69 @@
+from django.test import TestCase
+
+from nested_intervals.compaction import compact_children
+from nested_intervals.compaction import compact_subtree
+from nested_intervals.matrix import compose_path
+from nested_intervals.queryset import save_as_root
+from nested_intervals.tests.models import ExampleModel
+from nested_intervals.tests.test_model import create_test_tree
+
+
+class CompactionTest(TestCase):
+    def create_tree_with_gaps(self):
+        tree = create_test_tree()
+        for key in ('1.1', '1.2', '1', '2.1.1', '2.1'):
+            tree[key].delete()
+        return tree
+
+    def assert_paths(self, tree, paths):
+        for key, path in paths.items():
+            node = tree[key]
+            self.assertEqual(node.get_matrix(), compose_path(path))
+            if node.parent_id:
+                self.assertEqual(node.get_parent().pk, node.parent_id)
+
+    def test_compact_subtree(self):
+        tree = self.create_tree_with_gaps()
+
+        report = compact_subtree(ExampleModel.objects, batch_size=1)
+
+        self.assertEqual(report.moved, 3)
+        self.assertEqual(report.largest_value_before, 13)
+        self.assertEqual(report.largest_value_after, 8)
+        self.assert_paths(tree, {
+            '0': (1,),
+            '2': (1, 1),
+            '2.2': (1, 1, 1),
+            '3': (1, 2),
+            '3.1': (1, 2, 1),
+        })
+        self.assertEqual(compact_subtree(ExampleModel.objects).moved, 0)
+
+    def test_compact_children(self):
+        tree = self.create_tree_with_gaps()
+
+        report = compact_children(ExampleModel.objects, tree['0'].get_matrix())
+
+        self.assertEqual(report.moved, 2)
+        self.assert_paths(tree, {
+            '0': (1,),
+            '2': (1, 1),
+            '2.2': (1, 1, 2),
+            '3': (1, 2),
+            '3.1': (1, 2, 1),
+        })
+
+    def test_compact_roots(self):
+        roots = [ExampleModel(name=str(i)) for i in xrange(3)]
+        for root in roots:
+            save_as_root(root)
+        for nth, root in reversed(zip((2, 5, 9), roots)):
+            root.set_matrix(compose_path((nth,)))
+            root.save()
+
+        report = compact_children(ExampleModel.objects)
+
+        self.assertEqual(report.moved, 3)
+        self.assertEqual(
+            [ExampleModel.objects.get(pk=root.pk).get_matrix() for root in roots],
+            [compose_path((nth,)) for nth in (1, 2, 3)])
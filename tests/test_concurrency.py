@@ -0,0 +1,68 @@
+import threading
+from unittest import skipIf
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from nested_intervals.matrix import get_parent_matrix
+from nested_intervals.queryset import locked_save_as_child_of
+from nested_intervals.queryset import save_as_root
+from nested_intervals.tests.models import ExampleModel
+
+
+def in_memory_sqlite():
+    # Every thread gets its own in-memory database
+    return connection.vendor == 'sqlite' and not connection.settings_dict['TEST'].get('NAME')
+
+
+class ConcurrentInsertTest(TransactionTestCase):
+    threads = 10
+    inserts_per_thread = 100
+
+    def insert_children(self, parent, errors):
+        try:
+            for i in xrange(self.inserts_per_thread):
+                locked_save_as_child_of(ExampleModel(name=str(i)), parent, max_retries=1000)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    @skipIf(in_memory_sqlite(), 'Run with nested_intervals.tests.settings_concurrency')
+    def test_parallel_inserts(self):
+        parent = ExampleModel(name='parent')
+        save_as_root(parent)
+
+        errors = []
+        threads = [
+            threading.Thread(target=self.insert_children, args=(parent, errors))
+            for i in xrange(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        children = ExampleModel.objects.exclude(pk=parent.pk)
+        matrices = [child.get_matrix() for child in children]
+        self.assertEqual(len(matrices), self.threads * self.inserts_per_thread)
+        self.assertEqual(len(set(matrices)), len(matrices))
+        for matrix in matrices:
+            self.assertEqual(get_parent_matrix(matrix), parent.get_matrix())
+
+    def test_requires_unique_index(self):
+        parent = ExampleModel(name='parent')
+        save_as_root(parent)
+
+        unique_together = ExampleModel._meta.unique_together
+        ExampleModel._meta.unique_together = ()
+        try:
+            with self.assertRaises(AssertionError):
+                locked_save_as_child_of(ExampleModel(name='child'), parent)
+        finally:
+            ExampleModel._meta.unique_together = unique_together
+
+        locked_save_as_child_of(ExampleModel(name='child'), parent, False, max_retries=1)
+        self.assertEqual(parent.get_children().get().name, 'child')
@@ -1,5 +1,6 @@
 from django.test import TestCase
 
+from nested_intervals.models import bulk_create
 from nested_intervals.models import create
 from nested_intervals.models import update
 from nested_intervals.tests.models import ExampleModelWithoutNestedIntervals
@@ -22,6 +23,13 @@ class ModelCreateUpdateTest(TestCase):
         first, second = ExampleModelWithoutNestedIntervals.objects.order_by('pk')
         self.assertEqual([first.name, second.name], ['First', 'Second'])
 
+    def test_bulk_create(self):
+        pks = bulk_create(ExampleModelWithoutNestedIntervals, ('name',), [{'name': 'First'}, {'name': 'Second'}])
+        self.assertEqual(len(pks), 2)
+        self.assertEqual(
+            list(ExampleModelWithoutNestedIntervals.objects.order_by('pk').values_list('name', flat=True)),
+            ['First', 'Second'])
+
     def test_update(self):
         self.test_create()
         first, second = ExampleModelWithoutNestedIntervals.objects.order_by('pk')
@@ -0,0 +1,69 @@
+from django.db.models import F
+from django.test import TestCase
+
+from nested_intervals import batch
+from nested_intervals.integrity import KeyIndex
+from nested_intervals.integrity import check_integrity
+from nested_intervals.matrix import compose_path
+from nested_intervals.tests.models import ExampleModel
+from nested_intervals.tests.test_model import create_test_tree
+
+
+class IntegrityTest(TestCase):
+    def test_valid_tree(self):
+        create_test_tree()
+
+        report = check_integrity(ExampleModel.objects, chunk_size=3)
+
+        self.assertEqual(report.checked, 10)
+        self.assertTrue(report.is_valid)
+
+    def test_invalid_tree(self):
+        tree = create_test_tree()
+        node = tree['2']
+        node.set_matrix(compose_path((1, 9)))
+        node.save()
+        ExampleModel.objects.filter(pk=tree['3.1'].pk).update(lnumerator=F('lnumerator') + 1)
+        ExampleModel.objects.filter(pk=tree['1.1'].pk).update(parent=None)
+
+        report = check_integrity(ExampleModel.objects, chunk_size=3)
+
+        self.assertFalse(report.is_valid)
+        self.assertEqual(report.bad_determinants, [tree['3.1'].pk])
+        self.assertEqual(report.missing_parents, [tree['2.1'].pk, tree['2.2'].pk])
+        self.assertEqual(report.root_mismatches, [tree['1.1'].pk])
+        self.assertEqual(report.null_values, [])
+        self.assertEqual(report.out_of_range, [])
+
+    def test_out_of_range_values(self):
+        tree = create_test_tree()
+        ExampleModel.objects.filter(pk=tree['2.1'].pk).update(lnumerator=2 ** 40)
+
+        report = check_integrity(ExampleModel.objects, chunk_size=3)
+
+        # 2.1 is left out of the index, so it is not the parent of 2.1.1
+        self.assertEqual(report.out_of_range, [tree['2.1'].pk])
+        self.assertEqual(report.bad_determinants, [])
+        self.assertEqual(report.missing_parents, [tree['2.1.1'].pk])
+
+    def assert_key_index(self, max_value):
+        index = KeyIndex(max_value)
+        index.add([(1, 2), (2, 5), (1, 2)])
+        index.add([(3, 7), (2, 5)])
+
+        self.assertEqual(index.duplicates(), [(1, 2), (2, 5)])
+        self.assertEqual(index.missing([(1, 2), (1, 3), (3, 7)]), [False, True, False])
+        self.assertEqual(index.missing([(max_value + 1, 2), (-1, 2)]), [True, True])
+
+    def test_key_index(self):
+        self.assert_key_index(2 ** 31 - 1)
+        # Too large to pack into int64
+        self.assert_key_index(2 ** 63 - 1)
+
+    def test_key_index_without_numpy(self):
+        numpy = batch.numpy
+        batch.numpy = None
+        try:
+            self.assert_key_index(2 ** 31 - 1)
+        finally:
+            batch.numpy = numpy
@@ -0,0 +1,84 @@
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from nested_intervals.loader import load_tree
+from nested_intervals.loader import pairs_from_csv
+from nested_intervals.loader import pairs_from_queryset
+from nested_intervals.matrix import compose_path
+from nested_intervals.tests.models import ExampleModel
+from nested_intervals.tests.test_model import create_test_tree
+
+
+class LoaderTest(TestCase):
+    def scrambled_tree(self):
+        """
+        The test tree with every matrix overwritten, and the matrices it
+        should get back by pk.
+        """
+        create_test_tree()
+        matrices = dict(
+            (node.pk, node.get_matrix())
+            for node in ExampleModel.objects.all())
+        for i, node in enumerate(ExampleModel.objects.all()):
+            node.set_matrix(compose_path((100 + i,)))
+            node.save()
+        return matrices
+
+    def assert_matrices(self, matrices):
+        self.assertEqual(
+            dict((node.pk, node.get_matrix()) for node in ExampleModel.objects.all()),
+            matrices)
+
+    def test_load_from_queryset(self):
+        matrices = self.scrambled_tree()
+        progress = []
+
+        updated = load_tree(
+            ExampleModel.objects,
+            pairs_from_queryset(ExampleModel.objects),
+            chunk_size=4,
+            progress=lambda written, total: progress.append((written, total)))
+
+        self.assertEqual(updated, 10)
+        self.assertEqual(progress, [(4, 10), (8, 10), (10, 10)])
+        self.assert_matrices(matrices)
+
+    def test_load_from_csv(self):
+        matrices = self.scrambled_tree()
+        csv_file = StringIO('id,parent_id\n' + ''.join(
+            '{},{}\n'.format(pk, '' if parent_id is None else parent_id)
+            for pk, parent_id in ExampleModel.objects.order_by('pk').values_list('pk', 'parent_id')))
+
+        load_tree(ExampleModel.objects, pairs_from_csv(csv_file))
+
+        self.assert_matrices(matrices)
+
+    def test_reload_in_reversed_order(self):
+        # Without scrambling, the first child written takes the matrix its
+        # last sibling still holds
+        create_test_tree()
+        pairs = list(pairs_from_queryset(ExampleModel.objects))
+
+        load_tree(ExampleModel.objects, reversed(pairs), chunk_size=3)
+
+        self.assertEqual(
+            [node.name for node in ExampleModel.objects.tree_order()],
+            ['0', '3', '3.1', '2', '2.2', '2.1', '2.1.1', '1', '1.2', '1.1'])
+
+    def test_load_sets_parents(self):
+        a, b, c = [ExampleModel(name=name) for name in 'abc']
+        for i, node in enumerate((a, b, c)):
+            node.set_matrix(compose_path((i + 1,)))
+            node.save()
+
+        load_tree(ExampleModel.objects, [(a.pk, None), (b.pk, a.pk), (c.pk, b.pk)])
+
+        c = ExampleModel.objects.get(pk=c.pk)
+        self.assertEqual(c.parent_id, b.pk)
+        self.assertEqual(c.get_matrix(), compose_path((1, 1, 1)))
+        self.assertEqual([node.pk for node in c.get_ancestors().order_by('pk')], [a.pk, b.pk])
+
+    def test_unreachable(self):
+        with self.assertRaises(ValueError):
+            load_tree(ExampleModel.objects, [(1, None), (2, 3), (3, 2)])
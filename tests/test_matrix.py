@@ -1,10 +1,72 @@
+import sys
+import timeit
+
 from django.test import TestCase
 
 from nested_intervals.matrix import Matrix, get_ancestors_matrix
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
+from nested_intervals.matrix import compose_path
+from nested_intervals.matrix import get_child_matrix
+from nested_intervals.matrix import get_nth_path
+from nested_intervals.matrix import get_root_matrix
+from nested_intervals.matrix import iter_ancestors_matrix
 
 
 class MatrixTest(TestCase):
     def test_ancestors(self):
         self.assertEqual(
             get_ancestors_matrix(Matrix(7, -5, 10, -7)),
-            [Matrix(5, -3, 7, -4), Matrix(3, -1, 4, -1)])
+            (Matrix(5, -3, 7, -4), Matrix(3, -1, 4, -1)))
+
+    def test_ancestors_depth(self):
+        self.assertEqual(
+            get_ancestors_matrix(Matrix(7, -5, 10, -7), depth=1),
+            (Matrix(5, -3, 7, -4),))
+        self.assertEqual(
+            next(iter_ancestors_matrix(Matrix(7, -5, 10, -7))),
+            Matrix(5, -3, 7, -4))
+
+    def test_deep_ancestors(self):
+        matrix = INVISIBLE_ROOT_MATRIX
+        for i in xrange(5000):
+            matrix = get_child_matrix(matrix, 2)
+
+        ancestors = get_ancestors_matrix(matrix)
+        self.assertEqual(len(ancestors), 4999)
+        self.assertEqual(ancestors[-1], get_child_matrix(INVISIBLE_ROOT_MATRIX, 2))
+        self.assertEqual(get_root_matrix(matrix), ancestors[-1])
+
+    def test_value_type(self):
+        matrix = Matrix(7, -5, 10, -7)
+        # No per instance storage on top of the four entries
+        self.assertEqual(sys.getsizeof(matrix), sys.getsizeof((7, -5, 10, -7)))
+        self.assertEqual(tuple(matrix), (7, -5, 10, -7))
+        self.assertEqual({matrix: 1}[Matrix(7, -5, 10, -7)], 1)
+        self.assertEqual(len({matrix, Matrix(7, -5, 10, -7)}), 1)
+        self.assertNotEqual(matrix, Matrix(7, -5, 10, -8))
+
+    def test_compose_path(self):
+        nths = (1, 3, 2, 5)
+        matrix = INVISIBLE_ROOT_MATRIX
+        for nth in nths:
+            matrix = get_child_matrix(matrix, nth)
+
+        self.assertEqual(compose_path(nths), matrix)
+        self.assertEqual(compose_path(nths[2:], compose_path(nths[:2])), matrix)
+        self.assertEqual(get_nth_path(matrix), nths)
+        self.assertEqual(get_nth_path(INVISIBLE_ROOT_MATRIX), ())
+        self.assertEqual(
+            compose_path((2,) * 10),
+            INVISIBLE_ROOT_MATRIX * Matrix(3, -1, 1, 0) ** 10)
+
+    def test_compose_path_speed(self):
+        def chained():
+            matrix = INVISIBLE_ROOT_MATRIX
+            for nth in nths:
+                matrix = get_child_matrix(matrix, nth)
+            return matrix
+
+        nths = (2,) * 1000
+        chained_seconds = min(timeit.repeat(chained, number=10, repeat=3))
+        composed_seconds = min(timeit.repeat(lambda: compose_path(nths), number=10, repeat=3))
+        self.assertLess(composed_seconds, chained_seconds)
@@ -1,17 +1,39 @@
+from decimal import Decimal
+
 from django.core.exceptions import FieldError
+from django.db import connection
 from django.db import models
+from django.db.models import Max
+from django.db.models import Sum
 from django.test import TestCase
 
 import nested_intervals
+from nested_intervals.exceptions import InvalidNodeError
+from nested_intervals.exceptions import MatrixOverflowError
+from nested_intervals.matrix import INVISIBLE_ROOT_MATRIX
 from nested_intervals.matrix import Matrix
+from nested_intervals.matrix import compose_path
 from nested_intervals.matrix import get_child_matrix
+from nested_intervals.matrix import is_descendant_of_matrix
 from nested_intervals.models import NestedIntervalsModelMixin
+from nested_intervals.models import bulk_create
 from nested_intervals.models import create
 from nested_intervals.models import update
+from nested_intervals.tests.models import CachedExampleModel
 from nested_intervals.tests.models import ExampleModel
+from nested_intervals.tree import build_tree
+from nested_intervals.tree import iter_tree
+from nested_intervals.queryset import allocate_child_nths
+from nested_intervals.queryset import bulk_move_descendants_of_matrix
+from nested_intervals.queryset import children_of
+from nested_intervals.queryset import get_interval
+from nested_intervals.queryset import iter_preorder
+from nested_intervals.queryset import rollup_subtrees
+from nested_intervals.queryset import last_child_nth_of
 from nested_intervals.queryset import last_child_of
 from nested_intervals.queryset import save_as_child_of
 from nested_intervals.queryset import save_as_root
+from nested_intervals.queryset import update_intervals
 
 try:
     from collections import ChainMap
@@ -26,6 +48,14 @@ def create_for_test(Model, d_list):
         for d in d_list
     ])
 
+def bulk_create_for_test(Model, d_list, **kwargs):
+    return bulk_create(Model, ('name', 'parent_id',), [
+        ChainMap(d, {
+            'parent_id': None
+        })
+        for d in d_list
+    ], **kwargs)
+
 def update_for_test(Model, id_key_value, d):
     id_key, id_value = id_key_value
     return update(Model, ('parent_id',), {id_key: id_value}, d)
@@ -149,6 +179,435 @@ class RootTest(TestCase):
         self.assertEqual(tree['2.1.1'].get_matrix(), Matrix(3, -2, 5, -3))
 
 
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+
+class IndexTest(TestCase):
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        self.tree = create_test_tree()
+
+    def test_unique(self):
+        self.assertIn(('lnumerator', 'ldenominator'), ExampleModel._meta.unique_together)
+
+    def test_parent_uses_index(self):
+        plan = explain(ExampleModel.objects.filter(lnumerator=1, ldenominator=2))
+        self.assertIn('USING INDEX', plan)
+
+    def test_children_use_index(self):
+        plan = explain(self.tree['2'].get_children())
+        self.assertIn('USING INDEX', plan)
+
+    def test_last_child_uses_index(self):
+        node = self.tree['0']
+        plan = explain(children_of(node).order_by('-lnumerator').values_list('lnumerator', flat=True)[:1])
+        self.assertIn('USING COVERING INDEX', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_ancestors_use_index(self):
+        plan = explain(self.tree['2.1.1'].get_ancestors())
+        self.assertIn('USING INDEX', plan)
+
+    def test_descendants_use_index(self):
+        plan = explain(self.tree['2'].get_descendants())
+        self.assertIn('USING INDEX', plan)
+
+    def test_family_line_uses_index(self):
+        plan = explain(self.tree['2.1'].get_family_line())
+        self.assertIn('MULTI-INDEX OR', plan)
+        self.assertNotIn('SCAN TABLE tests_examplemodel', plan)
+        self.assertNotIn('SCAN tests_examplemodel', plan)
+
+
+class IntervalTest(TestCase):
+    def assert_intervals(self):
+        for node in ExampleModel.objects.all():
+            left, right = get_interval(node.get_matrix())
+            self.assertAlmostEqual(node.lbound, left, places=12)
+            self.assertAlmostEqual(node.rbound, right, places=12)
+
+    def assert_descendants(self):
+        nodes = ExampleModel.objects.all()
+        for node in nodes:
+            self.assertEqual(
+                set(n.pk for n in node.get_descendants()),
+                set(n.pk for n in nodes if is_descendant_of_matrix(n.get_matrix(), node.get_matrix())))
+
+    def test_intervals(self):
+        tree = create_test_tree()
+        self.assert_intervals()
+        self.assert_descendants()
+
+        update_for_test(ExampleModel, ('id', tree['2'].pk), {'parent_id': tree['3'].pk})
+        self.assert_intervals()
+
+        save_as_child_of(tree['3.1'], tree['1.1'])
+        self.assert_intervals()
+
+        bulk_create_for_test(ExampleModel, [{'name': '1.1.2', 'parent_id': tree['1.1'].pk}])
+        create_for_test(ExampleModel, [{'name': '1.1.3', 'parent_id': tree['1.1'].pk}])
+        self.assert_intervals()
+        self.assert_descendants()
+
+    def test_update_intervals(self):
+        create_test_tree()
+        ExampleModel.objects.update(lbound=None, rbound=None)
+
+        update_intervals(ExampleModel.objects)
+        self.assert_intervals()
+
+
+class TreeTest(TestCase):
+    def names(self, pairs):
+        return [(depth, node.name) for depth, node in pairs]
+
+    def test_descendants_tree(self):
+        tree = create_test_tree()
+        node = tree['2']
+
+        with self.assertNumQueries(1):
+            root = node.get_descendants_tree()
+
+        self.assertEqual(root.node, tree['2'])
+        self.assertEqual([child.node.name for child in root.children], ['2.1', '2.2'])
+        self.assertEqual(
+            self.names(root),
+            [(0, '2'), (1, '2.1'), (2, '2.1.1'), (1, '2.2')])
+
+    def test_descendants_tree_max_depth(self):
+        tree = create_test_tree()
+        node = tree['0']
+
+        with self.assertNumQueries(1):
+            root = node.get_descendants_tree(max_depth=1)
+        self.assertEqual(self.names(root), [(0, '0'), (1, '1'), (1, '2'), (1, '3')])
+
+        with self.assertNumQueries(1):
+            root = node.get_descendants_tree(max_depth=2)
+        self.assertEqual(
+            self.names(root),
+            [(0, '0'), (1, '1'), (2, '1.1'), (2, '1.2'), (1, '2'), (2, '2.1'), (2, '2.2'), (1, '3'), (2, '3.1')])
+
+    def test_descendants_tree_max_depth_without_depth_field(self):
+        tree = create_test_tree(CachedExampleModel, CachedExampleModel.objects.get)
+        node = tree['0']
+
+        with self.assertNumQueries(2):
+            root = node.get_descendants_tree(max_depth=2)
+        self.assertEqual(
+            self.names(root),
+            [(0, '0'), (1, '1'), (2, '1.1'), (2, '1.2'), (1, '2'), (2, '2.1'), (2, '2.2'), (1, '3'), (2, '3.1')])
+
+    def test_build_tree_of_decimal_values(self):
+        # The values of decimal storage
+        nodes = []
+        for name, path in (('0', (1,)), ('0.1', (1, 1)), ('0.2', (1, 2))):
+            node = ExampleModel(name=name)
+            node.set_matrix(compose_path(path))
+            for field_name in node._nested_intervals_field_names[0:-1]:
+                setattr(node, field_name, Decimal(getattr(node, field_name)))
+            nodes.append(node)
+
+        root, = build_tree(reversed(nodes))
+        self.assertEqual(self.names(iter_tree([root])), [(0, '0'), (1, '0.1'), (1, '0.2')])
+
+    def test_as_tree(self):
+        tree = create_test_tree()
+        create_for_test(ExampleModel, [{'name': '4'}])
+
+        roots = ExampleModel.objects.order_by('-pk').as_tree()
+        self.assertEqual([root.node.name for root in roots], ['0', '4'])
+        self.assertEqual(
+            [name for depth, name in self.names(iter_tree(roots))],
+            ['0', '1', '1.1', '1.2', '2', '2.1', '2.1.1', '2.2', '3', '3.1', '4'])
+
+        # Nodes whose parent is filtered out become roots
+        roots = ExampleModel.objects.exclude(name='2').as_tree()
+        self.assertEqual([root.node.name for root in roots], ['0', '2.1', '2.2', '4'])
+
+
+class DepthTest(TestCase):
+    def depths(self):
+        return dict(ExampleModel.objects.values_list('name', 'depth'))
+
+    def assert_depths(self):
+        for node in ExampleModel.objects.all():
+            self.assertEqual(node.depth, node.get_depth())
+            self.assertEqual(node.depth, len(node.get_ancestors()))
+
+    def test_depth(self):
+        create_test_tree()
+
+        self.assertEqual(self.depths(), {
+            '0': 0, '1': 1, '1.1': 2, '1.2': 2, '2': 1,
+            '2.1': 2, '2.1.1': 3, '2.2': 2, '3': 1, '3.1': 2})
+        self.assert_depths()
+
+    def test_depth_after_move(self):
+        tree = create_test_tree()
+
+        update_for_test(ExampleModel, ('id', tree['2'].pk), {'parent_id': tree['1.1'].pk})
+        self.assertEqual(self.depths()['2.1.1'], 5)
+        self.assert_depths()
+
+        save_as_root(tree['2.1'])
+        self.assertEqual(self.depths()['2.1.1'], 1)
+        self.assert_depths()
+
+    def test_depth_of_created(self):
+        tree = create_test_tree()
+        create_for_test(ExampleModel, [{'name': 'a', 'parent_id': tree['2.1.1'].pk}])
+        bulk_create_for_test(ExampleModel, [{'name': 'b', 'parent_id': tree['3.1'].pk}, {'name': 'c'}])
+
+        self.assertEqual(self.depths()['a'], 4)
+        self.assertEqual(self.depths()['b'], 3)
+        self.assertEqual(self.depths()['c'], 0)
+        self.assert_depths()
+
+    def test_at_depth(self):
+        tree = create_test_tree()
+
+        self.assertEqual(
+            sorted(node.name for node in ExampleModel.objects.at_depth(1)),
+            ['1', '2', '3'])
+        self.assertEqual(
+            sorted(node.name for node in tree['2'].get_descendants().at_depth(2)),
+            ['2.1', '2.2'])
+
+    def test_descendants_of_max_depth(self):
+        tree = create_test_tree()
+
+        self.assertEqual(
+            sorted(node.name for node in ExampleModel.objects.descendants_of(tree['2'], max_depth=1)),
+            ['2.1', '2.2'])
+        self.assertEqual(
+            sorted(node.name for node in tree['0'].get_descendants(max_depth=2)),
+            ['1', '1.1', '1.2', '2', '2.1', '2.2', '3', '3.1'])
+
+        with self.assertRaises(AssertionError):
+            CachedExampleModel.objects.at_depth(1)
+
+
+class ManyTest(TestCase):
+    def names(self, d):
+        return dict(
+            (node.name, [n.name for n in value] if isinstance(value, list) else value and value.name)
+            for node, value in d.items())
+
+    def test_children_of(self):
+        tree = create_test_tree()
+        self.assertEqual(
+            sorted(node.name for node in ExampleModel.objects.children_of(tree['2'])),
+            ['2.1', '2.2'])
+
+    def test_children_of_many(self):
+        create_test_tree()
+        nodes = list(ExampleModel.objects.all())
+
+        with self.assertNumQueries(1):
+            children = ExampleModel.objects.children_of_many(nodes)
+
+        self.assertEqual(self.names(children), {
+            '0': ['1', '2', '3'], '1': ['1.1', '1.2'], '1.1': [], '1.2': [],
+            '2': ['2.1', '2.2'], '2.1': ['2.1.1'], '2.1.1': [], '2.2': [],
+            '3': ['3.1'], '3.1': []})
+
+    def test_parents_of_many(self):
+        create_test_tree()
+        nodes = list(ExampleModel.objects.all())
+
+        with self.assertNumQueries(1):
+            parents = ExampleModel.objects.parents_of_many(nodes)
+
+        self.assertEqual(self.names(parents), {
+            '0': None, '1': '0', '1.1': '1', '1.2': '1', '2': '0',
+            '2.1': '2', '2.1.1': '2.1', '2.2': '2', '3': '0', '3.1': '3'})
+
+    def test_ancestors_of_many(self):
+        create_test_tree()
+        nodes = list(ExampleModel.objects.filter(name__in=['0', '1.2', '2.1.1']))
+
+        with self.assertNumQueries(1):
+            ancestors = ExampleModel.objects.ancestors_of_many(nodes)
+
+        self.assertEqual(self.names(ancestors), {
+            '0': [], '1.2': ['1', '0'], '2.1.1': ['2.1', '2', '0']})
+
+
+class PrefetchTest(TestCase):
+    def test_prefetch_ancestors(self):
+        create_test_tree()
+
+        with self.assertNumQueries(2):
+            nodes = list(ExampleModel.objects.filter(name__startswith='2').prefetch_ancestors())
+
+        with self.assertNumQueries(0):
+            ancestors = dict((node.name, [n.name for n in node.get_ancestors()]) for node in nodes)
+        self.assertEqual(ancestors, {
+            '2': ['0'], '2.1': ['2', '0'], '2.1.1': ['2.1', '2', '0'], '2.2': ['2', '0']})
+
+        # The same order as without prefetching
+        for node in nodes:
+            self.assertEqual(
+                [n.name for n in node.get_ancestors()],
+                [n.name for n in ExampleModel.objects.get(pk=node.pk).get_ancestors()])
+
+    def assert_prefetch_descendants(self, Model):
+        create_test_tree(Model, Model.objects.get)
+        queryset = Model.objects.filter(name__in=['0', '2']).order_by('name')
+
+        nodes = list(queryset.prefetch_descendants())
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [[n.name for n in node.get_descendants()] for node in nodes],
+                [['1', '1.1', '1.2', '2', '2.1', '2.1.1', '2.2', '3', '3.1'], ['2.1', '2.1.1', '2.2']])
+
+        nodes = list(queryset.prefetch_descendants(max_depth=1))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [[n.name for n in node.get_children()] for node in nodes],
+                [['1', '2', '3'], ['2.1', '2.2']])
+
+    def test_prefetch_descendants(self):
+        self.assert_prefetch_descendants(ExampleModel)
+
+        with self.assertNumQueries(2):
+            list(ExampleModel.objects.prefetch_descendants(max_depth=2))
+
+    def test_prefetch_descendants_without_interval_fields(self):
+        self.assert_prefetch_descendants(CachedExampleModel)
+
+        with self.assertNumQueries(2):
+            list(CachedExampleModel.objects.filter(name__in=['0', '2']).prefetch_descendants())
+        with self.assertNumQueries(2):
+            list(CachedExampleModel.objects.prefetch_descendants(max_depth=1))
+
+    def test_prefetch_is_cloned(self):
+        create_test_tree()
+        queryset = ExampleModel.objects.prefetch_ancestors()
+
+        node = queryset.filter(name='2.1').get()
+        with self.assertNumQueries(0):
+            self.assertEqual([n.name for n in node.get_ancestors()], ['2', '0'])
+
+
+class SubtreeAggregateTest(TestCase):
+    descendant_counts = {
+        '0': 9, '1': 2, '1.1': 0, '1.2': 0, '2': 3,
+        '2.1': 1, '2.1.1': 0, '2.2': 0, '3': 1, '3.1': 0}
+
+    def expected_depth_sums(self, Model):
+        return dict(
+            (node.name, sum(n.get_depth() for n in node.get_descendants()) + node.get_depth())
+            for node in Model.objects.all())
+
+    def test_annotate_descendant_count(self):
+        create_test_tree()
+
+        with self.assertNumQueries(1):
+            counts = dict(
+                (node.name, node.descendant_count)
+                for node in ExampleModel.objects.annotate_descendant_count())
+        self.assertEqual(counts, self.descendant_counts)
+
+        create_test_tree(CachedExampleModel, CachedExampleModel.objects.get)
+        self.assertEqual(
+            dict((node.name, node.descendant_count) for node in CachedExampleModel.objects.annotate_descendant_count()),
+            self.descendant_counts)
+
+    def test_annotate_subtree(self):
+        create_test_tree()
+
+        nodes = ExampleModel.objects.annotate_subtree(Sum('depth'), deepest=Max('depth'))
+        self.assertEqual(
+            dict((node.name, node.depth__sum) for node in nodes),
+            self.expected_depth_sums(ExampleModel))
+        self.assertEqual(
+            dict((node.name, node.deepest) for node in nodes.filter(name__in=['0', '2.2'])),
+            {'0': 3, '2.2': 2})
+
+    def test_rollup_subtrees(self):
+        tree = create_test_tree()
+        depth_sums = self.expected_depth_sums(ExampleModel)
+
+        totals = rollup_subtrees(ExampleModel.objects.all(), 'depth')
+        self.assertEqual(
+            dict((ExampleModel.objects.get(pk=pk).name, total) for pk, total in totals.items()),
+            dict((name, (self.descendant_counts[name], depth_sums[name])) for name in depth_sums))
+
+        totals = rollup_subtrees(tree['2'].get_subtree())
+        self.assertEqual(totals[tree['2'].pk], (3, 0))
+
+    def test_rollup_subtrees_of_narrow_intervals(self):
+        # Deep down a chain of second children the float bounds of
+        # neighbouring nodes coincide, and with the deepest nodes saved
+        # first the pk does not break the ties in depth first order
+        paths = [(2,) * depth for depth in xrange(1, 20)]
+        paths.extend((2,) * 19 + (nth,) for nth in xrange(1, 4))
+        paths.extend([(3,), (2, 1), (2, 3)])
+        for path in reversed(paths):
+            node = ExampleModel(name=str(len(path)))
+            node.set_matrix(compose_path(path))
+            node.save()
+
+        nodes = list(ExampleModel.objects.all())
+        totals = rollup_subtrees(ExampleModel.objects.all(), 'depth')
+        self.assertEqual(totals, dict(
+            (node.pk, (
+                len([n for n in nodes if is_descendant_of_matrix(n.get_matrix(), node.get_matrix())]),
+                sum(n.depth for n in nodes if n == node or is_descendant_of_matrix(n.get_matrix(), node.get_matrix()))))
+            for node in nodes))
+
+
+class PreorderTest(TestCase):
+    preorder = ['0', '1', '1.1', '1.2', '2', '2.1', '2.1.1', '2.2', '3', '3.1']
+
+    def test_iter_preorder(self):
+        create_test_tree()
+
+        with self.assertNumQueries(4):
+            names = [node.name for node in iter_preorder(ExampleModel.objects.all(), chunk_size=3)]
+        self.assertEqual(names, self.preorder)
+
+    def test_tree_order(self):
+        tree = create_test_tree()
+
+        with self.assertNumQueries(1):
+            names = [node.name for node in ExampleModel.objects.tree_order()]
+        self.assertEqual(names, self.preorder)
+        self.assertEqual(
+            [node.name for node in tree['2'].get_descendants().tree_order()],
+            ['2.1', '2.1.1', '2.2'])
+
+        create_test_tree(CachedExampleModel, CachedExampleModel.objects.get)
+        self.assertEqual(
+            [node.name for node in CachedExampleModel.objects.filter(name__startswith='2').tree_order()],
+            ['2', '2.1', '2.1.1', '2.2'])
+
+    def test_iter_descendants(self):
+        tree = create_test_tree()
+        node = tree['0']
+
+        with self.assertNumQueries(4):
+            names = [n.name for n in node.iter_descendants(chunk_size=3)]
+        self.assertEqual(names, self.preorder[1:])
+
+    def test_iter_descendants_without_interval_fields(self):
+        tree = create_test_tree(CachedExampleModel, CachedExampleModel.objects.get)
+
+        self.assertEqual(
+            [n.name for n in tree['2'].iter_descendants(chunk_size=2)],
+            ['2.1', '2.1.1', '2.2'])
+        self.assertEqual(
+            [n.name for n in iter_preorder(CachedExampleModel.objects.all(), chunk_size=1)],
+            self.preorder)
+
+
 class TestModel(TestCase):
     def test_invalid_model(self):
         with self.assertRaises(FieldError) as context:
@@ -185,6 +644,34 @@ class TestModel(TestCase):
             [tree[i].pk for i in ('0', '2', '2.1', '2.1.1')]
         )
 
+        for key in tree:
+            node = tree[key]
+            expected = set(node.get_ancestors()) | set(node.get_descendants()) | set([node])
+            self.assertEqual(set(node.get_family_line()), expected)
+            self.assertEqual(set(node.get_subtree()), set(node.get_descendants()) | set([node]))
+
+    def test_model_siblings(self):
+        tree = create_test_tree()
+
+        self.assertEqual(
+            sorted(node.name for node in tree['2'].get_siblings()),
+            ['1', '3'])
+        self.assertEqual(
+            sorted(node.name for node in tree['2.1'].get_siblings(include_self=True)),
+            ['2.1', '2.2'])
+        self.assertEqual(list(tree['2.1.1'].get_siblings()), [])
+        self.assertEqual(
+            sorted(node.name for node in ExampleModel.objects.siblings_of(tree['0'], include_self=True)),
+            ['0'])
+
+    def test_single_predicate(self):
+        tree = create_test_tree()
+        node = tree['2.1']
+
+        for queryset in (ExampleModel.objects.family_line_of(node), ExampleModel.objects.subtree_of(node)):
+            where = str(queryset.query).split(' WHERE ')[1]
+            self.assertNotIn('"id"', where)
+
 
 class ChildTest(TestCase):
     def test_save_children(self):
@@ -222,9 +709,32 @@ class ChildTest(TestCase):
                 )
             ])
 
+        # Backends without row values filter by the same query
+        self.assertEqual(
+            list(ExampleModel.objects.filter(child_2_1_1.get_ancestors_query()).order_by('pk')),
+            list(child_2_1_1.get_ancestors().order_by('pk')))
+
         # Test no ancestor matches
         self.assertEqual(tree['0'].get_ancestors().count(), 0)
 
+    def test_ancestors_of_deep_node(self):
+        nodes = []
+        for depth in xrange(1, 1001):
+            node = ExampleModel(name=str(depth))
+            node.set_matrix(compose_path((2,) + (1,) * (depth - 1)))
+            nodes.append(node)
+        ExampleModel.objects.bulk_create(nodes)
+        node = ExampleModel.objects.get(name='1000')
+
+        supports_row_values = nested_intervals.queryset.supports_row_values
+        for row_values in (True, False):
+            nested_intervals.queryset.supports_row_values = lambda connection: row_values
+            try:
+                self.assertEqual(node.get_ancestors().count(), 999)
+                self.assertEqual(node.get_family_line().count(), 1000)
+            finally:
+                nested_intervals.queryset.supports_row_values = supports_row_values
+
     def test_descendants(self):
         tree = create_test_tree()
         self.assertEqual(
@@ -306,6 +816,81 @@ class ChildTest(TestCase):
         # 2.2 remains unchanged
         self.assertEqual(tree['2.2'].get_matrix(), Matrix(21, -8, 50, -19))
 
+    def test_save_existing_node_as_child_of(self):
+        tree = create_test_tree()
+
+        nodes = save_as_child_of(tree['2'], tree['3'])
+
+        self.assertEqual(
+            sorted(node.pk for node in nodes),
+            sorted(tree[i].pk for i in ('2', '2.1', '2.1.1', '2.2')))
+        self.assertEqual(tree['2'].get_matrix(), Matrix(8, -3, 19, -7))
+        self.assertEqual(tree['2.1'].get_matrix(), Matrix(13, -8, 31, -19))
+        self.assertEqual(tree['2.1.1'].get_matrix(), Matrix(18, -13, 43, -31))
+        self.assertEqual(tree['2.2'].get_matrix(), Matrix(21, -8, 50, -19))
+        self.assertEqual(
+            [tree[i].parent for i in ('2', '2.1', '2.1.1', '2.2')],
+            [tree[i] for i in ('3', '2', '2.1', '2')])
+
+    def test_bulk_move_descendants_of_matrix(self):
+        # The fallback for MySQL, whose UPDATE reads already updated fields
+        tree = create_test_tree()
+        old_matrix = tree['2'].get_matrix()
+        new_matrix = get_child_matrix(tree['3'].get_matrix(), 2)
+
+        with self.assertNumQueries(4):
+            bulk_move_descendants_of_matrix(ExampleModel.objects, old_matrix, new_matrix)
+
+        self.assertEqual(tree['2.1'].get_matrix(), Matrix(13, -8, 31, -19))
+        self.assertEqual(tree['2.1.1'].get_matrix(), Matrix(18, -13, 43, -31))
+        self.assertEqual(tree['2.2'].get_matrix(), Matrix(21, -8, 50, -19))
+        self.assertEqual(tree['2.1.1'].depth, 4)
+        self.assertEqual((tree['2.2'].lbound, tree['2.2'].rbound), get_interval(tree['2.2'].get_matrix()))
+
+    def test_move_child_under_own_descendant(self):
+        tree = create_test_tree()
+
+        with self.assertRaises(InvalidNodeError):
+            update_for_test(ExampleModel, ('id', tree['2'].pk), {'parent_id': tree['2.1'].pk})
+
+        # No changes happened
+        self.assertEqual(tree['2'].get_matrix(), Matrix(2, -1, 5, -2))
+        self.assertEqual(tree['2.1.1'].get_matrix(), Matrix(4, -3, 11, -8))
+
+    def test_move_child_overflow(self):
+        tree = create_test_tree()
+        matrices = dict((name, tree[name].get_matrix()) for name in tree)
+
+        ExampleModel._nested_intervals_max_value = 20
+        try:
+            with self.assertRaises(MatrixOverflowError):
+                update_for_test(ExampleModel, ('id', tree['2'].pk), {'parent_id': tree['3.1'].pk})
+        finally:
+            ExampleModel._nested_intervals_max_value = 2 ** 31 - 1
+
+        # No changes happened
+        self.assertEqual(dict((name, tree[name].get_matrix()) for name in tree), matrices)
+
+    def test_save_existing_node_under_own_descendant(self):
+        tree = create_test_tree()
+
+        for name in ('2', '2.1', '2.1.1'):
+            with self.assertRaises(InvalidNodeError):
+                save_as_child_of(tree['2'], tree[name])
+
+        # No changes happened
+        self.assertEqual(tree['2'].get_matrix(), Matrix(2, -1, 5, -2))
+        self.assertEqual(tree['2'].parent, tree['0'])
+        self.assertEqual(tree['2.1.1'].get_matrix(), Matrix(4, -3, 11, -8))
+
+    def test_allocate_child_nths(self):
+        tree = create_test_tree()
+
+        self.assertEqual(last_child_nth_of(ExampleModel.objects, tree['0'].get_matrix()), 3)
+        self.assertEqual(last_child_nth_of(ExampleModel.objects, tree['1.1'].get_matrix()), 0)
+        self.assertEqual(last_child_nth_of(ExampleModel.objects, INVISIBLE_ROOT_MATRIX), 1)
+        self.assertEqual(list(allocate_child_nths(ExampleModel.objects, tree['2'].get_matrix(), 3)), [3, 4, 5])
+
     def test_save_child_repeatedly(self):
         """
         Saving the same child to the same parent will
@@ -351,3 +936,28 @@ class ChildTest(TestCase):
         root, child1, child3, child4 = ExampleModel.objects.order_by('pk')
         self.assertEqual(child3.name, 'Child 3')
         self.assertEqual(child4.get_abs_matrix(), Matrix(4, 1, 9, 2))
+
+    def test_bulk_create(self):
+        tree = create_test_tree()
+
+        pks = bulk_create_for_test(ExampleModel, [
+            {'name': '3.2', 'parent_id': tree['3'].pk},
+            {'name': '4'},
+            {'name': '1.1.1', 'parent_id': tree['1.1'].pk},
+            {'name': '3.3', 'parent_id': tree['3'].pk},
+            {'name': '5'},
+        ], batch_size=2)
+
+        self.assertEqual(
+            [ExampleModel.objects.get(pk=pk).name for pk in pks],
+            ['3.2', '4', '1.1.1', '3.3', '5'])
+        self.assertEqual(
+            [ExampleModel.objects.get(pk=pk).get_matrix() for pk in pks],
+            [
+                get_child_matrix(tree['3'].get_matrix(), 2),
+                Matrix(2, -1, 3, -1),
+                get_child_matrix(tree['1.1'].get_matrix(), 1),
+                get_child_matrix(tree['3'].get_matrix(), 3),
+                Matrix(3, -1, 4, -1),
+            ])
+        self.assertEqual(ExampleModel.objects.get(pk=pks[0]).parent, tree['3'])
@@ -0,0 +1,92 @@
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from nested_intervals.matrix import compose_path
+from nested_intervals.rebuild import rebuild_nested_intervals
+from nested_intervals.tests.models import ExampleModel
+from nested_intervals.tests.test_model import create_test_tree
+
+
+class RebuildTest(TestCase):
+    def matrices(self):
+        return dict((node.pk, node.get_matrix()) for node in ExampleModel.objects.all())
+
+    def test_consistent_tree(self):
+        create_test_tree()
+        matrices = self.matrices()
+
+        report = rebuild_nested_intervals(ExampleModel.objects)
+
+        self.assertEqual(report, (10, 0, 0))
+        self.assertEqual(self.matrices(), matrices)
+
+    def test_changed_parent(self):
+        tree = create_test_tree()
+        ExampleModel.objects.filter(pk=tree['2.1'].pk).update(parent=tree['3'].pk)
+
+        report = rebuild_nested_intervals(ExampleModel.objects)
+
+        self.assertEqual(report.updated, 2)
+        self.assertEqual(tree['3.1'].get_matrix(), compose_path((1, 3, 1)))
+        self.assertEqual(tree['2.1'].get_matrix(), compose_path((1, 3, 2)))
+        self.assertEqual(tree['2.1.1'].get_matrix(), compose_path((1, 3, 2, 1)))
+        self.assertEqual(tree['2.1.1'].get_parent(), tree['2.1'])
+        self.assertEqual(
+            set(tree['3'].get_descendants()),
+            set([tree['3.1'], tree['2.1'], tree['2.1.1']]))
+
+    def test_swapped_parents(self):
+        # Each moved node takes the matrix the other still holds
+        tree = create_test_tree()
+        ExampleModel.objects.filter(pk=tree['2.1'].pk).update(parent=tree['3'].pk)
+        ExampleModel.objects.filter(pk=tree['3.1'].pk).update(parent=tree['2'].pk)
+
+        rebuild_nested_intervals(ExampleModel.objects)
+
+        self.assertEqual(tree['3.1'].get_matrix(), compose_path((1, 2, 1)))
+        self.assertEqual(tree['2.1'].get_matrix(), compose_path((1, 3, 1)))
+        self.assertEqual(tree['2.1.1'].get_matrix(), compose_path((1, 3, 1, 1)))
+        self.assertEqual(
+            set(tree['2'].get_descendants()),
+            set([tree['3.1'], tree['2.2']]))
+        self.assertEqual(
+            set(tree['3'].get_descendants()),
+            set([tree['2.1'], tree['2.1.1']]))
+
+    def test_corrupt_matrix(self):
+        tree = create_test_tree()
+        matrices = self.matrices()
+        node = tree['2.2']
+        node.set_matrix(compose_path((3, 2)))
+        node.save()
+
+        report = rebuild_nested_intervals(ExampleModel.objects, root_ids=[tree['0'].pk])
+
+        self.assertEqual(report, (10, 1, None))
+        self.assertEqual(self.matrices(), matrices)
+
+    def test_other_root(self):
+        tree = create_test_tree()
+        other = ExampleModel(name='other')
+        other.set_matrix(compose_path((5, 5)))
+        other.save()
+
+        report = rebuild_nested_intervals(ExampleModel.objects, root_ids=[tree['0'].pk])
+
+        self.assertEqual(report.checked, 10)
+        self.assertEqual(ExampleModel.objects.get(pk=other.pk).get_matrix(), compose_path((5, 5)))
+
+        report = rebuild_nested_intervals(ExampleModel.objects, root_ids=[other.pk])
+
+        self.assertEqual(report.updated, 1)
+        self.assertEqual(ExampleModel.objects.get(pk=other.pk).get_matrix(), compose_path((5,)))
+
+    def test_command(self):
+        create_test_tree()
+        stdout = StringIO()
+
+        call_command('rebuild_nested_intervals', 'tests.ExampleModel', stdout=stdout)
+
+        self.assertEqual(stdout.getvalue(), '10 rows checked, 0 rows updated\n')
@@ -0,0 +1,65 @@
+"""
+Assemble model instances into a tree in memory, linking each node to its
+parent with the (a12, a22) -> (a11, a21) relation of their matrices.
+"""
+from nested_intervals.matrix import get_preorder_key
+
+
+class TreeNode(object):
+    __slots__ = ('node', 'children')
+
+    def __init__(self, node, children=None):
+        self.node = node
+        self.children = [] if children is None else children
+
+    def __repr__(self):
+        return 'TreeNode({!r}, {} children)'.format(self.node, len(self.children))
+
+    def __iter__(self):
+        return iter_tree((self,))
+
+def get_abs_values(node):
+    # int() because decimal storage returns Decimal values
+    return tuple(
+        int(getattr(node, field_name))
+        for field_name in node._nested_intervals_field_names[0:-1])
+
+def get_nth_of(tree_node):
+    v11, v12, v21, v22 = get_abs_values(tree_node.node)
+    return v11 // v12
+
+def build_tree(nodes):
+    """
+    Returns the TreeNodes of every node whose parent is not among nodes,
+    in depth first order, with children sorted by nth.
+    """
+    tree_nodes = []
+    by_key = {}
+    for node in nodes:
+        v11, v12, v21, v22 = get_abs_values(node)
+        tree_node = TreeNode(node)
+        by_key[(v11, v21)] = tree_node
+        tree_nodes.append((tree_node, (v12, v22)))
+
+    roots = []
+    for tree_node, parent_key in tree_nodes:
+        parent = by_key.get(parent_key)
+        if parent is None:
+            roots.append(tree_node)
+        else:
+            parent.children.append(tree_node)
+
+    for tree_node, parent_key in tree_nodes:
+        tree_node.children.sort(key=get_nth_of)
+    roots.sort(key=lambda root: get_preorder_key(get_abs_values(root.node)))
+    return roots
+
+def iter_tree(roots):
+    """
+    Yields (depth, node) pairs depth first, where roots have depth 0.
+    """
+    stack = [(0, root) for root in reversed(roots)]
+    while stack:
+        depth, tree_node = stack.pop()
+        yield depth, tree_node.node
+        stack.extend((depth + 1, child) for child in reversed(tree_node.children))
@@ -0,0 +1,13 @@
+from itertools import islice
+
+# Upper bound on the number of values put in a single IN (...) list,
+# which keeps every query well under SQLite's bound parameter limit.
+QUERY_CHUNK_SIZE = 500
+
+def chunked(iterable, size=QUERY_CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = tuple(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk